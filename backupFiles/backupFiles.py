@@ -3,20 +3,376 @@
 import argparse
 import sys
 import os
-from distutils.dir_util import copy_tree
-from distutils.file_util import copy_file
+import shutil
+import sqlite3
+import hashlib
+import json
+import errno
+import queue
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
-__version__ = '0.0.1'
+__version__ = '0.1.0'
 __prog__ = 'backupFiles'
 __name_version__ = __prog__ + ' ' + __version__
 
-def output_log(log_file, processed, ignored):
+MANIFEST_NAME = '.backupFiles.manifest'
+HASH_BLOCK_SIZE = 1 << 20
+COMMIT_INTERVAL = 10000
+COPY_BLOCK_SIZE = 1 << 30
+MIN_TASK_BYTES = 1 << 16
+
+# Content defined chunking: every byte is mapped to one of 16 pseudo random
+# symbols, and a chunk ends where the last 5 symbols spell CHUNK_PATTERN (one
+# chance in 2**20). Mapping (bytes.translate) and search (bytes.find) both run
+# in C, a Python loop over the bytes of a rolling hash ran at a few MB/s
+CHUNK_MIN = 1 << 19
+CHUNK_MAX = 1 << 22
+CHUNK_READ_SIZE = 4 * CHUNK_MAX
+CHUNK_TABLE = bytes(hashlib.blake2b(bytes([i]), digest_size=1).digest()[0] & 0xF for i in range(256))
+CHUNK_PATTERN = bytes((0x5A3C9 >> (4 * i)) & 0xF for i in range(5))
+
+# Matches root itself and every path below it, with the parameters of subtree(root)
+SUBTREE = '(path = ? OR (path >= ? AND path < ?))'
+
+def subtree(root):
+	# '0' directly follows os.sep in ASCII, so this range is exactly root's subtree
+	prefix = root.rstrip(os.sep) + os.sep
+	return (root, prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+
+class Manifest:
+	"""Persistent index of the backed up files, keyed by source path.
+
+	Each row stores the size, mtime, inode and content hash the file had when
+	it was last copied, and the id of the last run that saw it so deleted files
+	can be found without keeping the whole tree in memory."""
+
+	def __init__(self, path):
+		self.path = path
+		self.db = sqlite3.connect(path)
+		# The manifest can be on a network share, where the shared memory WAL index is not
+		# supported, an exclusive lock keeps it in process memory
+		self.db.execute('PRAGMA locking_mode=EXCLUSIVE')
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, ' \
+						'mtime_ns INTEGER, inode INTEGER, digest BLOB, run INTEGER) WITHOUT ROWID')
+		self.db.execute('CREATE TABLE IF NOT EXISTS chunks (path TEXT PRIMARY KEY, chunks TEXT) ' \
+						'WITHOUT ROWID')
+		self.db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, date TEXT)')
+		self.run = self.db.execute('INSERT INTO runs (date) VALUES (?)',
+								   (dt.today().isoformat(),)).lastrowid
+		self.pending = 0
+
+	def touch(self, path, st):
+		"""Mark path as seen if its metadata did not change, return True in that case"""
+		cur = self.db.execute('UPDATE files SET run = ? WHERE path = ? AND size = ? AND ' \
+							  'mtime_ns = ? AND inode = ?',
+							  (self.run, path, st.st_size, st.st_mtime_ns, st.st_ino))
+		self._changed()
+		return cur.rowcount == 1
+
+	def keep(self, path):
+		"""Mark path as seen without updating it, so it is not reported deleted"""
+		self.db.execute('UPDATE files SET run = ? WHERE path = ?', (self.run, path))
+		self._changed()
+
+	def digest(self, path):
+		row = self.db.execute('SELECT digest FROM files WHERE path = ?', (path,)).fetchone()
+		return row[0] if row is not None else None
+
+	def chunks(self, path):
+		"""Return the chunks list of path stored in repository mode, None if unknown"""
+		row = self.db.execute('SELECT chunks FROM chunks WHERE path = ?', (path,)).fetchone()
+		return row[0].split() if row is not None else None
+
+	def update(self, path, st, digest, chunks=None):
+		self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+						(path, st.st_size, st.st_mtime_ns, st.st_ino, digest, self.run))
+		if chunks is not None:
+			self.db.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?)', (path, ' '.join(chunks)))
+		else:
+			# Stored by a copy run, the chunks of a previous repository run are stale
+			self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+		self._changed()
+
+	def unseen(self, root):
+		"""Return the paths under root that were not seen during this run"""
+		cur = self.db.execute('SELECT path FROM files WHERE run != ? AND ' + SUBTREE,
+							  (self.run,) + subtree(root))
+		return [row[0] for row in cur]
+
+	def keep_tree(self, root):
+		"""keep() every path under root, e.g. a folder that could not be read"""
+		self.db.execute('UPDATE files SET run = ? WHERE ' + SUBTREE, (self.run,) + subtree(root))
+		self._changed()
+
+	def remove(self, path):
+		self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+		self.db.execute('DELETE FROM chunks WHERE path = ?', (path,))
+		self._changed()
+
+	def _changed(self):
+		self.pending += 1
+		if self.pending >= COMMIT_INTERVAL:
+			self.db.commit()
+			self.pending = 0
+
+	def close(self):
+		self.db.commit()
+		self.db.close()
+
+def file_digest(path):
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+			h.update(block)
+	return h.digest()
+
+def walk_files(folder, failed):
+	"""Yield (path, stat) for every file below folder, one stat per file.
+
+	Folders and files that cannot be read are appended to failed, the files
+	below them are unknown but not deleted."""
+	try:
+		with os.scandir(folder) as it:
+			for entry in it:
+				try:
+					is_dir = entry.is_dir()
+					st = None if is_dir or not entry.is_file() else entry.stat()
+				except OSError as e:
+					warnings.warn('Cannot read ' + entry.path + ': ' + str(e))
+					failed.append(entry.path)
+					continue
+				if is_dir:
+					yield from walk_files(entry.path, failed)
+				elif st is not None:
+					yield entry.path, st
+	except OSError as e:
+		# Opening the folder or listing it (e.g. an unmounted NFS share) failed
+		warnings.warn('Cannot read ' + folder + ': ' + str(e))
+		failed.append(folder)
+
+def _copy_range(fsrc, fdst, size):
+	"""Copy size bytes in kernel space, return False if not supported here"""
+	copied = 0
+	for method in ('copy_file_range', 'sendfile'):
+		if not hasattr(os, method):
+			continue
+		try:
+			while copied < size:
+				if method == 'copy_file_range':
+					n = os.copy_file_range(fsrc, fdst, min(size - copied, COPY_BLOCK_SIZE))
+				else:
+					n = os.sendfile(fdst, fsrc, None, min(size - copied, COPY_BLOCK_SIZE))
+				if n == 0:
+					break
+				copied += n
+			return True
+		except OSError as e:
+			# Only fall back if nothing was written yet, offsets are unknown otherwise
+			if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+										 errno.EOPNOTSUPP, errno.EBADF):
+				raise
+	return False
+
+def copy_file(src, destination):
+	"""Copy src content, mode and times to destination, in kernel space when possible"""
+	with open(src, 'rb') as fsrc, open(destination, 'wb') as fdst:
+		size = os.fstat(fsrc.fileno()).st_size
+		if not _copy_range(fsrc.fileno(), fdst.fileno(), size):
+			shutil.copyfileobj(fsrc, fdst, HASH_BLOCK_SIZE)
+	shutil.copystat(src, destination)
+
+def copy_if_changed(src, destination, old_digest):
+	"""Copy src to destination unless its content matches old_digest.
+
+	Returns (digest, copied, chunks). Only called for files whose metadata changed."""
+	digest = file_digest(src)
+	if digest == old_digest and os.path.exists(destination):
+		return digest, False, None
+	os.makedirs(os.path.dirname(destination), exist_ok=True)
+	copy_file(src, destination)
+	return digest, True, None
+
+def find_cut(symbols, start, length):
+	"""Return the length of the chunk at start, symbols being the data mapped with CHUNK_TABLE"""
+	end = min(length, CHUNK_MAX)
+	if end <= CHUNK_MIN:
+		return end
+	# The pattern may start before the minimum size, the cut only depends on
+	# the content right before it
+	i = symbols.find(CHUNK_PATTERN, start + CHUNK_MIN - len(CHUNK_PATTERN), start + end)
+	return end if i < 0 else i + len(CHUNK_PATTERN) - start
+
+def iter_chunks(f):
+	"""Split the content of file object f in content defined chunks"""
+	buf = b''
+	symbols = b''
+	pos = 0
+	eof = False
+	while not eof or pos < len(buf):
+		if not eof and len(buf) - pos < CHUNK_MAX:
+			block = f.read(CHUNK_READ_SIZE)
+			eof = not block
+			buf = buf[pos:] + block
+			symbols = symbols[pos:] + block.translate(CHUNK_TABLE)
+			pos = 0
+			continue
+		cut = find_cut(symbols, pos, len(buf) - pos)
+		yield buf[pos:pos + cut]
+		pos += cut
+
+class Repository:
+	"""Deduplicated store: unique chunks stored once under their hash, and one
+	manifest per snapshot listing the chunks of every file"""
+
+	def __init__(self, folder):
+		self.folder = folder
+		self.chunks_dir = os.path.join(folder, 'chunks')
+		self.snapshots_dir = os.path.join(folder, 'snapshots')
+		os.makedirs(self.chunks_dir, exist_ok=True)
+		os.makedirs(self.snapshots_dir, exist_ok=True)
+
+	def chunk_path(self, chunk):
+		return os.path.join(self.chunks_dir, chunk[:2], chunk)
+
+	def store_chunk(self, data):
+		chunk = hashlib.blake2b(data, digest_size=20).hexdigest()
+		path = self.chunk_path(chunk)
+		if not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			# Written aside and renamed, a concurrent writer of the same chunk is harmless
+			tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+			with open(tmp, 'wb') as f:
+				f.write(data)
+			os.replace(tmp, path)
+		return chunk
+
+	def store_file(self, src, destination, old_digest):
+		"""Store the chunks of src, same signature and result as copy_if_changed"""
+		h = hashlib.blake2b(digest_size=16)
+		chunks = []
+		with open(src, 'rb') as f:
+			for data in iter_chunks(f):
+				chunk = self.store_chunk(data)
+				h.update(bytes.fromhex(chunk))
+				chunks.append(chunk)
+		digest = h.digest()
+		return digest, digest != old_digest, chunks
+
+	def snapshots(self):
+		return sorted(name[:-len('.jsonl')] for name in os.listdir(self.snapshots_dir)
+					  if name.endswith('.jsonl'))
+
+	def new_snapshot(self):
+		return Snapshot(os.path.join(self.snapshots_dir,
+									 dt.today().strftime('%Y-%m-%d-%H%M%S-%f') + '.jsonl'))
+
+	def read_snapshot(self, name):
+		if name == 'latest':
+			name = self.snapshots()[-1]
+		with open(os.path.join(self.snapshots_dir, name + '.jsonl'), 'r') as f:
+			for line in f:
+				yield json.loads(line)
+
+	def restore_file(self, entry, destination):
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		with open(destination, 'wb') as f:
+			for chunk in entry['chunks']:
+				with open(self.chunk_path(chunk), 'rb') as c:
+					shutil.copyfileobj(c, f)
+		os.chmod(destination, entry['mode'])
+		os.utime(destination, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+class Snapshot:
+	"""Snapshot manifest, one json line per file, only visible once complete"""
+
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path + '.part', 'w')
+
+	def add(self, path, st, chunks):
+		self.f.write(json.dumps({'path': path, 'size': st.st_size, 'mode': st.st_mode & 0o7777,
+								 'mtime_ns': st.st_mtime_ns, 'chunks': chunks}) + '\n')
+
+	def close(self):
+		self.f.close()
+		os.replace(self.path + '.part', self.path)
+
+class ByteBudget:
+	"""Bound the number of bytes being copied at the same time"""
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.in_flight = 0
+		self.cond = threading.Condition()
+
+	def acquire(self, n):
+		with self.cond:
+			# A file bigger than the limit is let through alone
+			self.cond.wait_for(lambda: self.in_flight == 0 or self.in_flight + n <= self.limit)
+			self.in_flight += n
+
+	def release(self, n):
+		with self.cond:
+			self.in_flight -= n
+			self.cond.notify_all()
+
+class CopyPool:
+	"""Copy workers with one queue per source device.
+
+	Each device gets its own workers so a slow disk does not hold back the
+	others, results are handed back through a queue so the manifest is only
+	accessed from the main thread."""
+
+	def __init__(self, jobs, max_bytes, task=copy_if_changed):
+		self.jobs = jobs
+		self.task = task
+		self.budget = ByteBudget(max_bytes)
+		self.executors = {}
+		self.results = queue.SimpleQueue()
+
+	def submit(self, src, st, destination, old_digest):
+		cost = max(st.st_size, MIN_TASK_BYTES)
+		self.budget.acquire(cost)
+		executor = self.executors.get(st.st_dev)
+		if executor is None:
+			executor = ThreadPoolExecutor(max_workers=self.jobs,
+										  thread_name_prefix='copy-{}'.format(st.st_dev))
+			self.executors[st.st_dev] = executor
+		executor.submit(self._run, src, st, destination, old_digest, cost)
+
+	def _run(self, src, st, destination, old_digest, cost):
+		try:
+			result = self.task(src, destination, old_digest)
+		except Exception as e:
+			result = e
+		finally:
+			self.budget.release(cost)
+		self.results.put((src, st, destination, result))
+
+	def completed(self):
+		while True:
+			try:
+				yield self.results.get_nowait()
+			except queue.Empty:
+				return
+
+	def shutdown(self):
+		for executor in self.executors.values():
+			executor.shutdown(wait=True)
+
+def output_log(log_file, copied, unchanged, deleted, ignored):
 	log_string = __name_version__ + '\n' + \
 				dt.today().strftime('%Y-%m-%d-%H:%M:%S') + '\n\n' + \
-				'Processed :\n' + \
-				'\n'.join(elem for elem in processed) + \
+				'Copied :\n' + \
+				'\n'.join(elem for elem in copied) + \
+				'\n\nUnchanged : {} files'.format(unchanged) + \
+				'\n\nDeleted :\n' + \
+				'\n'.join(elem for elem in deleted) + \
 				'\n\nIgnored :\n' + \
 				'\n'.join(elem for elem in ignored) + '\n'
 	print(log_string)
@@ -33,7 +389,36 @@ def main(args):
 	print('')
 
 	ignored = []
-	processed = []
+	copied = []
+	deleted = []
+	unchanged = 0
+	roots = []
+	failed = []
+	manifest = Manifest(args.manifest)
+	if args.repository:
+		repository = Repository(args.dest_folder)
+		snapshot = repository.new_snapshot()
+		task = repository.store_file
+	else:
+		snapshot = None
+		task = copy_if_changed
+	pool = CopyPool(args.jobs, args.max_bytes, task) if args.jobs > 1 else None
+
+	def record(src, st, destination, result):
+		nonlocal unchanged
+		if isinstance(result, Exception):
+			warnings.warn('Cannot backup ' + src + ': ' + str(result))
+			ignored.append(src)
+			manifest.keep(src)
+			return
+		(digest, was_copied, chunks) = result
+		manifest.update(src, st, digest, chunks)
+		if snapshot is not None:
+			snapshot.add(src, st, chunks)
+		if was_copied:
+			copied.append(src if snapshot is not None else '{} -> {}'.format(src, destination))
+		else:
+			unchanged += 1
 
 	for f in files_to_bkp:
 		if not os.path.isabs(f):
@@ -46,24 +431,86 @@ def main(args):
 			ignored.append(f)
 			continue
 
-		destination = os.path.join(args.dest_folder, *f.split(os.sep))
-
 		if os.path.isfile(f):
-			os.makedirs(os.path.dirname(destination), exist_ok=True)
-			(dest_name, _) = copy_file(f, destination,
-									   preserve_mode=True, update=True)
-			processed.append('{} -> {}'.format(f, dest_name))
+			files = [(f, os.stat(f))]
 		elif os.path.isdir(f):
-			dest_names = copy_tree(f, destination,
-								   preserve_mode=True, update=True)
-			for i in dest_names:
-				processed.append('{} -> {}'.format(i.replace(args.dest_folder, ''), i))
+			files = walk_files(f, failed)
 		else:
 			warnings.warn(f + ' is neither a file or directory')
 			ignored.append(f)
 			continue
+		roots.append(f)
+
+		for (src, st) in files:
+			if manifest.touch(src, st):
+				if snapshot is None:
+					unchanged += 1
+					continue
+				chunks = manifest.chunks(src)
+				if chunks is not None:
+					snapshot.add(src, st, chunks)
+					unchanged += 1
+					continue
+			destination = os.path.join(args.dest_folder, *src.split(os.sep))
+			if pool is None:
+				try:
+					result = task(src, destination, manifest.digest(src))
+				except Exception as e:
+					result = e
+				record(src, st, destination, result)
+			else:
+				pool.submit(src, st, destination, manifest.digest(src))
+				for done in pool.completed():
+					record(*done)
+
+	if pool is not None:
+		pool.shutdown()
+		for done in pool.completed():
+			record(*done)
+
+	# Whatever was under an unreadable folder is unknown, not deleted
+	for f in failed:
+		manifest.keep_tree(f)
+		ignored.append(f)
+
+	# Only once every copy is recorded, files still in flight would look deleted
+	for f in roots:
+		for src in manifest.unseen(f):
+			destination = os.path.join(args.dest_folder, *src.split(os.sep))
+			if args.delete and not args.repository and os.path.isfile(destination):
+				os.remove(destination)
+			manifest.remove(src)
+			deleted.append(src if snapshot is not None else '{} -> {}'.format(src, destination))
+
+	manifest.close()
+	if snapshot is not None:
+		snapshot.close()
+		print('Snapshot : {}\n'.format(snapshot.path))
+	output_log(args.log_file, copied, unchanged, deleted, ignored)
+	sys.exit(0)
+
+def restore(args):
+	with open(args.input_file, 'r') as f:
+		roots = [line.rstrip('\n').rstrip(os.sep) for line in f if line.strip()]
+	(name, target) = args.restore
+	target = os.path.abspath(target)
+	repository = Repository(args.dest_folder)
+	snapshots = repository.snapshots()
+	if name == 'latest' and not snapshots:
+		sys.exit('No snapshot in repository ' + args.dest_folder)
+	if name != 'latest' and name not in snapshots:
+		sys.exit('Snapshot ' + name + ' not found in repository ' + args.dest_folder)
+
+	restored = []
+	for entry in repository.read_snapshot(name):
+		path = entry['path']
+		if not any(path == root or path.startswith(root + os.sep) for root in roots):
+			continue
+		destination = os.path.join(target, *path.split(os.sep))
+		repository.restore_file(entry, destination)
+		restored.append('{} -> {}'.format(path, destination))
 
-	output_log(args.log_file, processed, ignored)
+	print('Restored :\n' + '\n'.join(restored))
 	sys.exit(0)
 
 def create_dir(string):
@@ -89,7 +536,27 @@ def parse_args():
 	parser.add_argument('-v', '--version', action='version', version=__name_version__)
 	parser.add_argument('-l', '--log_file', type=argparse.FileType('w'),
 						help='Log file to store processed and ignored files lists')
+	parser.add_argument('-m', '--manifest', default=None,
+						help='Manifest storing the state of the backed up files ' \
+							 '(default: ' + MANIFEST_NAME + ' in destination folder)')
+	parser.add_argument('-d', '--delete', action='store_true',
+						help='Remove from destination folder the files deleted from the source')
+	parser.add_argument('-j', '--jobs', type=int, default=1,
+						help='Number of copy workers per source device (default: 1)')
+	parser.add_argument('--max-mb', type=int, default=256, dest='max_mb',
+						help='Maximum megabytes being copied at the same time with --jobs ' \
+							 '(default: 256)')
+	parser.add_argument('-r', '--repository', action='store_true',
+						help='Store files as deduplicated chunks and a snapshot manifest ' \
+							 'in destination folder instead of copying them')
+	parser.add_argument('--restore', nargs=2, metavar=('SNAPSHOT', 'TARGET'),
+						help='Restore the input file paths of SNAPSHOT (name or latest) from ' \
+							 'the repository in destination folder to TARGET folder')
 	args = parser.parse_args()
+	args.max_bytes = args.max_mb << 20
+
+	if args.manifest is None:
+		args.manifest = os.path.join(args.dest_folder, MANIFEST_NAME)
 
 	if args.log_file is not None:
 		print('Log file : {}\n'.format(args.log_file.name))
@@ -98,4 +565,6 @@ def parse_args():
 
 if __name__ == '__main__':
 	args = parse_args()
+	if args.restore is not None:
+		restore(args)
 	main(args)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Benchmark the scripts of this repository on synthetic workloads, offline.
+
+Every tool runs as a subprocess, against stub binaries (stubs/) and a local
+fake TMDb server (fake_tmdb.py). Results are written as JSON with a fixed
+structure and sorted keys, so runs can be compared with a plain diff."""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_tmdb import FakeTMDb
+import workloads
+
+__version__ = '0.1.0'
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+# Seconds between two reads of the peak RSS of a tool
+RSS_POLL = 0.01
+TOOLS = ['backupFiles', 'rencodeFlac', 'upscale', 'sortdl']
+
+def script(*path):
+    return [sys.executable, os.path.join(REPO_DIR, *path)]
+
+def peak_rss(pid):
+    """Return the peak RSS of process pid in bytes, None once it has exited"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def measure(cmd, cwd, env, log_path):
+    """Run cmd, return its wall time, exit code and peak RSS (of cmd itself, not its children)"""
+    with open(log_path, 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        # The rusage of wait4 would include the children, VmHWM is cmd's own peak. It is
+        # read until cmd exits (a zombie has none), so the last RSS_POLL seconds may be missed
+        peak = [0]
+        done = threading.Event()
+
+        def poll():
+            while not done.is_set():
+                rss = peak_rss(process.pid)
+                if rss is None:
+                    break
+                peak[0] = max(peak[0], rss)
+                done.wait(RSS_POLL)
+
+        poller = threading.Thread(target=poll)
+        poller.start()
+        # Not reaped until the polling stops, so that the pid can't be reused meanwhile
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        wall = time.monotonic() - start
+        done.set()
+        poller.join()
+        process.wait()
+    return wall, process.returncode, peak[0]
+
+class Bench:
+    def __init__(self, work_dir, scale, latency, tmdb_latency):
+        self.work_dir = work_dir
+        self.scale = scale
+        self.env = dict(os.environ, BENCH_STUB_LATENCY=str(latency))
+        self.tmdb_latency = tmdb_latency
+        self.results = []
+
+    def folder(self, *path):
+        folder = os.path.join(self.work_dir, *path)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def run(self, tool, case, cmd, files, size, cwd=None, **extra):
+        print(f"{tool} {case}: {files} files, {size / 1e6:.1f} MB", file=sys.stderr)
+        log_path = os.path.join(self.work_dir, f"{tool}-{case}.log")
+        wall, returncode, peak_rss = measure(cmd, cwd or self.work_dir, self.env, log_path)
+        if returncode != 0:
+            print(f"{tool} {case} failed ({returncode}), see {log_path}", file=sys.stderr)
+        result = {
+            'tool': tool,
+            'case': case,
+            'files': files,
+            'bytes': size,
+            'returncode': returncode,
+            'wall_seconds': round(wall, 3),
+            'files_per_second': round(files / wall, 1),
+            'mb_per_second': round(size / 1e6 / wall, 1),
+            'peak_rss_mb': round(peak_rss / 2**20, 1),
+        }
+        result.update(extra)
+        self.results.append(result)
+
+    def backupFiles(self):
+        files = 500 * self.scale
+        source = self.folder('backup-source')
+        size = workloads.file_tree(source, files, 1 << 16)
+        list_file = os.path.join(self.work_dir, 'backup.list')
+        with open(list_file, 'w') as f:
+            f.write(source + '\n')
+        tool = script('backupFiles', 'backupFiles.py')
+        self.run('backupFiles', 'copy', tool + [list_file, self.folder('backup-copy')], files, size)
+        self.run('backupFiles', 'copy-jobs4', tool + ['-j', '4', list_file, self.folder('backup-jobs')], files, size)
+        # Nothing changed since the previous run
+        self.run('backupFiles', 'incremental', tool + ['-j', '4', list_file, self.folder('backup-jobs')], files, size)
+        self.run('backupFiles', 'repository', tool + ['-r', list_file, self.folder('backup-repository')], files, size)
+
+    def rencodeFlac(self):
+        files = 20 * self.scale
+        source = self.folder('flac-source')
+        size = workloads.flac_files(source, files, 5, corrupted=1)
+        flac = os.path.join(STUBS_DIR, 'flac')
+        tool = script('rencodeFlac', 'rencodeFlac.py') + ['-i', source, '--decoder-bin', flac, '--encoder-bin', flac,
+                                                           '-j', '4']
+        self.run('rencodeFlac', 'stream', tool + ['-o', self.folder('flac-stream')], files, size)
+        # The journal shows every file as done
+        self.run('rencodeFlac', 'resume', tool + ['-o', self.folder('flac-stream')], files, size)
+        self.run('rencodeFlac', 'temp-wav', tool + ['-o', self.folder('flac-wav'), '--temp-wav'], files, size)
+
+    def upscale(self):
+        files = 8 * self.scale
+        source = self.folder('upscale-source')
+        size = workloads.jpeg_files(source, files, 640, 480)
+        tool = script('upscale', 'upscale.py') + [source, '-s', '2', '--upscayl-bin',
+                                                  os.path.join(STUBS_DIR, 'upscayl-bin'),
+                                                  '-t', self.folder('upscale-tmp'), '--convert-jobs', '2',
+                                                  '--upscale-jobs', '2', '--compress-jobs', '2']
+        self.run('upscale', 'pipeline', tool, files, size)
+        # The cache shows every output as done
+        self.run('upscale', 'cached', tool, files, size)
+
+    def sortdl(self):
+        config_dir = self.folder('sortdl')
+        server = FakeTMDb(latency=self.tmdb_latency).start()
+        with open(os.path.join(config_dir, 'config.ini'), 'w') as f:
+            f.write(f"[API]\ntmdb_api_key = benchmark\napi_base = {server.url}\n\n"
+                    f"[Cache]\npath = {os.path.join(config_dir, 'cache.sqlite')}\n")
+        tool = script('sortDownloads', 'sortdl.py')
+
+        source = os.path.join(config_dir, 'downloads')
+
+        def run(case, make_tree):
+            shutil.rmtree(source, ignore_errors=True)
+            files, size = make_tree()
+            before = sum(server.requests.values())
+            self.run('sortdl', case, tool + [source, self.folder('sortdl', 'movies'), self.folder('sortdl', 'tv')],
+                     files, size, cwd=config_dir)
+            self.results[-1]['tmdb_requests'] = sum(server.requests.values()) - before
+
+        downloads = lambda: workloads.downloads_tree(source, 50 * self.scale, 5 * self.scale, 10)
+        run('cold-cache', downloads)
+        run('warm-cache', downloads)
+        # No video at all, only files to delete
+        files = 200 * self.scale
+        run('no-video', lambda: (files, workloads.file_tree(source, files, 512)))
+        server.shutdown()
+
+def main(args):
+    tools = args.tool or TOOLS
+    work_dir = tempfile.mkdtemp(prefix='bench-', dir=args.work_dir)
+    bench = Bench(work_dir, args.scale, args.latency, args.tmdb_latency)
+    try:
+        for tool in tools:
+            getattr(bench, tool)()
+    finally:
+        if args.keep:
+            print(f"Work files kept in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        'version': __version__,
+        'parameters': {'scale': args.scale, 'latency': args.latency, 'tmdb_latency': args.tmdb_latency,
+                       'tools': tools},
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                        'cpu_count': os.cpu_count()},
+        'results': bench.results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+    if any(result['returncode'] != 0 for result in bench.results):
+        sys.exit(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the scripts on synthetic workloads, offline')
+    parser.add_argument('-t', '--tool', action='append', choices=TOOLS,
+                        help='Tool to benchmark, can be repeated (default: all)')
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='Multiplies the size of every workload (default: 1)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every stub binary call (default: 0)')
+    parser.add_argument('--tmdb-latency', type=float, default=0.02,
+                        help='Seconds added to every fake TMDb response (default: 0.02)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('-w', '--work-dir', default=None,
+                        help='Folder for the generated workloads (default: system temporary folder)')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='Keep the generated workloads and the tool logs')
+    parser.add_argument('-v', '--version', action='version', version='bench ' + __version__)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Local server answering the TMDb requests made by sortdl.py.
+
+Answers are derived from the query, so they are the same on every run. Titles
+containing "unknown" find nothing. Every response is delayed by latency
+seconds, to stand for the network."""
+
+import argparse
+import json
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+EPISODES_PER_SEASON = 30
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query).get('query', [''])[0]
+        time.sleep(self.server.latency)
+        season = re.fullmatch(r'/3/tv/(\d+)/season/(\d+)', url.path)
+        episode = re.fullmatch(r'/3/tv/(\d+)/season/(\d+)/episode/(\d+)', url.path)
+        if url.path == '/3/search/movie':
+            endpoint = 'search/movie'
+            results = [] if 'unknown' in query.lower() else [
+                {'id': zlib.crc32(query.encode()), 'title': query.title(),
+                 'release_date': f"{1950 + zlib.crc32(query.encode()) % 70}-01-01"}]
+            body = {'page': 1, 'results': results, 'total_pages': 1, 'total_results': len(results)}
+        elif url.path == '/3/search/tv':
+            endpoint = 'search/tv'
+            results = [] if 'unknown' in query.lower() else [
+                {'id': zlib.crc32(query.encode()) % 100000, 'original_name': query.title()}]
+            body = {'page': 1, 'results': results, 'total_pages': 1, 'total_results': len(results)}
+        elif season:
+            endpoint = 'tv/season'
+            body = {'season_number': int(season.group(2)),
+                    'episodes': [{'episode_number': n, 'name': f"Episode {n}"}
+                                 for n in range(1, EPISODES_PER_SEASON + 1)]}
+        elif episode:
+            endpoint = 'tv/season/episode'
+            body = {'episode_number': int(episode.group(3)), 'name': f"Episode {episode.group(3)}"}
+        else:
+            self.send_error(404)
+            return
+        with self.server.lock:
+            self.server.requests[endpoint] += 1
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTMDb(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/3"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake TMDb API server for sortdl.py')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response (default: 0.05)')
+    args = parser.parse_args()
+    server = FakeTMDb(args.port, args.latency)
+    print(f"Serving on {server.url}, set api_base = {server.url} in config.ini")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,102 @@
+"""Synthetic inputs for the benchmarks, the same for a given seed"""
+
+import hashlib
+import os
+import random
+import struct
+
+FLAC_HEADER_SIZE = 42
+WAV_HEADER_SIZE = 44
+SAMPLE_RATE = 44100
+
+def wav_bytes(pcm):
+    """16 bit stereo WAV file of pcm"""
+    fmt = struct.pack('<HHIIHH', 1, 2, SAMPLE_RATE, SAMPLE_RATE * 4, 4, 16)
+    return (b'RIFF' + struct.pack('<I', 36 + len(pcm)) + b'WAVE' + b'fmt ' + struct.pack('<I', 16) + fmt
+            + b'data' + struct.pack('<I', len(pcm)) + pcm)
+
+def flac_bytes(pcm):
+    """fLaC marker and a valid STREAMINFO, followed by pcm instead of real frames"""
+    total_samples = len(pcm) // 4
+    # sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1 (5 bits), total samples (36 bits)
+    fields = (SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | total_samples
+    streaminfo = (struct.pack('>HH', 4096, 4096) + b'\0' * 6 + struct.pack('>Q', fields)
+                  + hashlib.md5(pcm).digest())
+    return b'fLaC' + bytes([0x80, 0, 0, len(streaminfo)]) + streaminfo + pcm
+
+def file_tree(root, files, size, seed=0, fanout=16):
+    """Create files files of about size bytes under root, fanout entries per folder.
+
+    Returns the total size written."""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        # The digits of i in base fanout give the folders, e.g. 12/3/file-3123
+        folders = []
+        n = i // fanout
+        while n:
+            folders.append(f"d{n % fanout}")
+            n //= fanout
+        folder = os.path.join(root, *folders)
+        os.makedirs(folder, exist_ok=True)
+        length = rng.randint(size // 2, size * 3 // 2)
+        with open(os.path.join(folder, f"file-{i}"), 'wb') as f:
+            f.write(rng.randbytes(length))
+        total += length
+    return total
+
+def flac_files(folder, files, seconds, seed=0, corrupted=0):
+    """Create fake FLAC files of seconds of noise, the first corrupted ones with a bad frame"""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    total = 0
+    for i in range(files):
+        pcm = bytearray(rng.randbytes(int(seconds * SAMPLE_RATE) * 4))
+        if i < corrupted:
+            pcm[len(pcm) // 2:len(pcm) // 2 + 7] = b'CORRUPT'
+        data = flac_bytes(bytes(pcm))
+        with open(os.path.join(folder, f"track-{i:04}.flac"), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+def jpeg_files(folder, files, width, height, seed=0):
+    """Create noisy jpg pictures, noise being the worst case for the jpeg encoder"""
+    from PIL import Image
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    total = 0
+    for i in range(files):
+        path = os.path.join(folder, f"picture-{i:04}.jpg")
+        Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3)).save(path, quality=90)
+        total += os.path.getsize(path)
+    return total
+
+def downloads_tree(root, movies, shows, episodes, seed=0, size=1 << 16):
+    """Create a download folder as sortdl finds it.
+
+    Movies come in their own folder with a subtitle and an nfo, episodes of a
+    show share a folder, and some files don't match anything on TMDb."""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(movies):
+        title = f"Movie.Title.{i}" if i % 10 else f"Unknown.Thing.{i}"
+        folder = os.path.join(root, f"{title}.{1950 + i % 70}.1080p.BluRay.x264-GROUP")
+        paths += [os.path.join(folder, f"{title}.{1950 + i % 70}.1080p.BluRay.x264-GROUP.mkv"),
+                  os.path.join(folder, 'Subs', 'English.srt'),
+                  os.path.join(folder, 'RARBG.nfo')]
+    for i in range(shows):
+        folder = os.path.join(root, f"Show.Name.{i}.S01.720p.WEB")
+        for episode in range(1, episodes + 1):
+            # A double episode now and then
+            name = f"E{episode:02}E{episode + 1:02}" if episode % 7 == 0 else f"E{episode:02}"
+            paths.append(os.path.join(folder, f"Show.Name.{i}.S01{name}.720p.WEB.mkv"))
+        paths.append(os.path.join(folder, 'info.txt'))
+    total = 0
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        length = size if path.endswith('.mkv') else 512
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(length))
+        total += length
+    return len(paths), total
@@ -1,9 +1,30 @@
 import argparse
+import array
 from pathlib import Path
 import subprocess
 import tempfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from datetime import datetime
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+JOURNAL_NAME = ".rencodeFlac.journal"
+# Discovered jobs held back to be started largest first
+ORDER_WINDOW = 4096
+PIPE_BLOCK_SIZE = 1 << 20
+# WAV stores 8 bits samples unsigned, FLAC hashes them signed
+SIGN_FLIP = bytes((i + 128) & 0xFF for i in range(256))
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
 def run_allow_errors(cmd):
     """Run a command and capture output. Returns returncode, stdout, stderr."""
@@ -11,30 +32,484 @@ def run_allow_errors(cmd):
     proc = subprocess.run(cmd, capture_output=True, text=True)
     return proc.returncode, proc.stdout, proc.stderr
 
-def reencode_flac(input_path: Path, output_dir: Path, decoder_bin: str, encoder_bin: str):
-    """Decode a FLAC file to WAV, then re-encode it, ignoring decode errors."""
-    output_path = output_dir / input_path.name
-    output_path = output_path.with_suffix(".flac")
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        wav_path = Path(tmpdir) / "decoded.wav"
-
-        # Step 1: decode
-        decode_cmd = [decoder_bin, "-d", "-F", str(input_path), "-o", str(wav_path)]
-        rc, _, err = run_allow_errors(decode_cmd)
-        if rc != 0:
-            print(f"⚠ Decode reported errors for {input_path.name}: {err}")
-        if not wav_path.exists():
-            print(f"❌ No WAV produced for {input_path.name}, skipping.")
+def run_pipe_allow_errors(decode_cmd, encode_cmd, tee=None):
+    """Pipe decoder stdout into encoder stdin. Returns both returncodes and stderrs.
+
+    Without tee the processes are connected directly, otherwise the stream goes
+    through this process and every block is also passed to tee."""
+    print("Running:", " ".join(decode_cmd), "|", " ".join(encode_cmd))
+    # Decoder stderr goes to a file, on corrupted input it can fill a pipe nobody reads yet
+    with tempfile.TemporaryFile() as decode_err:
+        decoder = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=decode_err)
+        if tee is None:
+            encoder = subprocess.Popen(encode_cmd, stdin=decoder.stdout,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            # Only the encoder holds the read end now, so the decoder gets SIGPIPE if it exits
+            decoder.stdout.close()
+            _, encode_err = encoder.communicate()
+        else:
+            encoder = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            encode_err = pump(decoder, encoder, tee)
+        decoder.wait()
+        decode_err.seek(0)
+        return decoder.returncode, decode_err.read().decode(errors="replace"), encoder.returncode, encode_err
+
+def pump(decoder, encoder, tee):
+    """Copy decoder stdout to encoder stdin through tee. Returns the encoder stderr."""
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(encoder.stderr.read()))
+    reader.start()
+    try:
+        for block in iter(lambda: decoder.stdout.read(PIPE_BLOCK_SIZE), b""):
+            tee(block)
+            encoder.stdin.write(block)
+    except BrokenPipeError:
+        pass
+    finally:
+        decoder.stdout.close()
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        encoder.wait()
+        reader.join()
+    return stderr[0].decode(errors="replace") if stderr else ""
+
+class PcmMd5:
+    """MD5 of the samples of a WAV stream, computed the way FLAC computes the
+    STREAMINFO MD5, so both can be compared without decoding again."""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.header = b""
+        self.in_data = False
+        self.valid = True
+        self.remaining = None
+        self.sign_flip = False
+        # Bytes per sample and bits below the valid ones, WAV left-justifies e.g. 12 bits samples
+        self.width = 0
+        self.shift = 0
+        self.partial = b""
+
+    def update(self, data: bytes):
+        if not self.valid:
             return
+        if not self.in_data:
+            self.header += data
+            data = self._parse_header()
+            if not self.in_data:
+                return
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if self.sign_flip:
+            data = data.translate(SIGN_FLIP)
+        if self.shift:
+            data = self._unshift(data)
+        self.md5.update(data)
+
+    def _unshift(self, data):
+        """FLAC hashes the samples as they were, not padded to the container."""
+        data = self.partial + data
+        end = len(data) - len(data) % self.width
+        self.partial = data[end:]
+        w, shift = self.width, self.shift
+        typecode = {1: "b", 2: "h", 4: "i"}.get(w)
+        if typecode:
+            samples = array.array(typecode, data[:end])
+            if sys.byteorder == "big":
+                samples.byteswap()
+            samples = array.array(typecode, (sample >> shift for sample in samples))
+            if sys.byteorder == "big":
+                samples.byteswap()
+            return samples.tobytes()
+        # 3 bytes samples, no array type for them
+        return b"".join((int.from_bytes(data[i:i + w], "little", signed=True) >> shift)
+                        .to_bytes(w, "little", signed=True) for i in range(0, end, w))
+
+    def _parse_header(self):
+        """Return the data following the 'data' chunk header once it is found."""
+        h = self.header
+        if len(h) < 12:
+            return b""
+        if h[:4] not in (b"RIFF", b"RF64") or h[8:12] != b"WAVE":
+            self.valid = False
+            return b""
+        pos = 12
+        while pos + 8 <= len(h):
+            chunk_id, size = h[pos:pos + 4], int.from_bytes(h[pos + 4:pos + 8], "little")
+            if chunk_id == b"data":
+                self.in_data = True
+                # A streamed or RF64 header may not know the data size
+                if size not in (0, 0xFFFFFFFF) and h[:4] == b"RIFF":
+                    self.remaining = size
+                data = h[pos + 8:]
+                self.header = b""
+                return data
+            if chunk_id == b"fmt " and pos + 8 + size <= len(h):
+                field = lambda offset: int.from_bytes(h[pos + 8 + offset:pos + 10 + offset], "little")
+                channels, block_align, bits = field(2), field(12), field(14)
+                if field(0) == WAVE_FORMAT_EXTENSIBLE and size >= 20:
+                    bits = field(18)
+                self.width = block_align // channels if channels else 0
+                if not 0 < bits <= 8 * self.width:
+                    self.valid = False
+                    return b""
+                self.sign_flip = self.width == 1
+                self.shift = 8 * self.width - bits
+            elif chunk_id == b"fmt ":
+                return b""
+            pos += 8 + size + (size & 1)
+        return b""
+
+    def hexdigest(self):
+        return self.md5.hexdigest() if self.valid and self.in_data else None
+
+def streaminfo_md5(path: Path):
+    """Read the MD5 of the decoded samples from a FLAC STREAMINFO block, None if unset or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(10)
+            if head[:3] == b"ID3":
+                # Skip an ID3v2 tag some taggers put before the stream, size is syncsafe
+                size = 0
+                for b in head[6:10]:
+                    size = (size << 7) | (b & 0x7F)
+                f.seek(10 + size)
+                head = f.read(10)
+            f.seek(-len(head), os.SEEK_CUR)
+            block = f.read(4 + 4 + 34)
+    except OSError:
+        return None
+    # 'fLaC', then the STREAMINFO block header and body, the MD5 ends the body
+    if len(block) < 42 or block[:4] != b"fLaC" or block[4] & 0x7F != 0:
+        return None
+    md5 = block[26:42]
+    return md5.hex() if any(md5) else None
+
+def wav_md5(path: Path):
+    hasher = PcmMd5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(PIPE_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def file_digest(path: Path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+@dataclass
+class Job:
+    """One FLAC file to re-encode, and the outcome of each stage."""
+    input_path: Path
+    output_path: Path
+    key: str
+    size: int
+    mtime_ns: int
+    digest: Optional[str] = None
+    wav_dir: Optional[str] = None
+    decode_rc: Optional[int] = None
+    encode_rc: Optional[int] = None
+    decoded_md5: Optional[str] = None
+    source_md5: Optional[str] = None
+    output_md5: Optional[str] = None
+    status: str = "failed"
+
+    @property
+    def source_corrupted(self):
+        """The decoder complained, or did not give back the samples the source was encoded from."""
+        return self.decode_rc != 0 or (self.decoded_md5 is not None and self.source_md5 is not None
+                                       and self.decoded_md5 != self.source_md5)
+
+    @property
+    def part_path(self):
+        """Encoder output, only renamed to output_path once complete."""
+        return self.output_path.with_name(self.output_path.name + ".part")
+
+def valid_flac(path: Path):
+    """Check the encoder produced a non empty FLAC stream."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == b"fLaC"
+    except OSError:
+        return False
+
+def finish_output(job: Job):
+    """Atomically publish the encoder output if it is valid, drop it otherwise.
+
+    When the decoded stream was hashed, the output must also hold those samples."""
+    job.status = "failed"
+    if job.encode_rc == 0 and valid_flac(job.part_path):
+        job.status = "ok"
+        if job.decoded_md5 is not None:
+            job.output_md5 = streaminfo_md5(job.part_path)
+            if job.output_md5 != job.decoded_md5:
+                print(f"❌ Output of {job.input_path.name} does not match the decoded samples")
+                job.status = "mismatch"
+    if job.status == "ok":
+        os.replace(job.part_path, job.output_path)
+    else:
+        job.part_path.unlink(missing_ok=True)
+
+class Report:
+    """Summary of the run, listing the files needing attention."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"ok": 0, "failed": 0, "mismatch": 0}
+        self.corrupted = []
+        self.problems = []
+
+    def add(self, job: Job):
+        with self.lock:
+            self.counts[job.status] = self.counts.get(job.status, 0) + 1
+            if job.status != "ok":
+                self.problems.append({"path": job.key, "status": job.status})
+            if job.source_corrupted:
+                self.corrupted.append({"path": job.key, "decode_rc": job.decode_rc,
+                                       "decoded_md5": job.decoded_md5, "source_md5": job.source_md5})
+
+    def print(self):
+        print(f"\nSummary: {self.counts['ok']} re-encoded, {self.counts['failed']} failed, "
+              f"{self.counts['mismatch']} output not matching the decoded samples.")
+        for problem in self.problems:
+            print(f"❌ {problem['status']}: {problem['path']}")
+        if self.corrupted:
+            print(f"{len(self.corrupted)} corrupted source(s), decoder errors or samples not matching their STREAMINFO MD5:")
+        for corrupted in self.corrupted:
+            reasons = []
+            if corrupted["decode_rc"] != 0:
+                reasons.append("decoder errors")
+            if None not in (corrupted["decoded_md5"], corrupted["source_md5"]) \
+                    and corrupted["decoded_md5"] != corrupted["source_md5"]:
+                reasons.append("MD5 mismatch")
+            print(f"⚠ {corrupted['path']} ({', '.join(reasons)})")
+
+    def write(self, path: Path):
+        with open(path, "w") as f:
+            json.dump({"counts": self.counts, "problems": self.problems, "corrupted": self.corrupted}, f, indent=2)
+
+class Journal:
+    """Record of the source files already re-encoded, to resume interrupted runs.
+
+    Keyed by path relative to the input directory. A file is done if it was
+    re-encoded successfully and its size and mtime did not change, or if they
+    changed but its content hash did not."""
 
-        # Step 2: encode
-        encode_cmd = [encoder_bin, str(wav_path), "-o", str(output_path)]
-        rc, _, err = run_allow_errors(encode_cmd)
-        if rc != 0:
-            print(f"⚠ Encode reported errors for {input_path.name}: {err}")
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, size INTEGER, "
+                            "mtime_ns INTEGER, digest TEXT, status TEXT, details TEXT, date TEXT)")
+            self.db.commit()
+
+    def is_done(self, job: Job):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, digest, status FROM jobs WHERE path = ?",
+                                  (job.key,)).fetchone()
+        if row is None or row[3] != "ok" or not job.output_path.exists():
+            return False
+        if (row[0], row[1]) == (job.size, job.mtime_ns):
+            return True
+        job.digest = file_digest(job.input_path)
+        if job.digest != row[2]:
+            return False
+        with self.lock:
+            self.db.execute("UPDATE jobs SET size = ?, mtime_ns = ? WHERE path = ?",
+                            (job.size, job.mtime_ns, job.key))
+            self.db.commit()
+        return True
+
+    def record(self, job: Job):
+        details = {"decode_rc": job.decode_rc, "encode_rc": job.encode_rc, "decoded_md5": job.decoded_md5,
+                   "source_md5": job.source_md5, "output_md5": job.output_md5}
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (job.key, job.size, job.mtime_ns, job.digest, job.status,
+                             json.dumps(details), datetime.now().isoformat()))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def encoder_cmd(encoder_bin: str, threads: int):
+    """Encoder command prefix, overwriting a stale .part output, with flac's own threads when more than one is asked."""
+    return [encoder_bin, "-f"] + ([f"--threads={threads}"] if threads > 1 else [])
+
+def reencode_flac(job: Job, decoder_bin: str, encode_cmd: list, verify: bool = True):
+    """Decode a FLAC file and pipe the decoded WAV into the encoder, ignoring decode errors.
+
+    With verify the decoded samples are hashed on their way to the encoder."""
+    input_path, output_path = job.input_path, job.output_path
+    decode_cmd = [decoder_bin, "-d", "-F", "-c", str(input_path)]
+    hasher = PcmMd5() if verify else None
+    decode_rc, decode_err, rc, err = run_pipe_allow_errors(decode_cmd, encode_cmd + ["-", "-o", str(job.part_path)],
+                                                           hasher.update if verify else None)
+    job.decode_rc, job.encode_rc = decode_rc, rc
+    if verify:
+        job.decoded_md5 = hasher.hexdigest()
+        job.source_md5 = streaminfo_md5(input_path)
+    if decode_rc != 0:
+        print(f"⚠ Decode reported errors for {input_path.name}: {decode_err}")
+    if rc != 0:
+        print(f"⚠ Encode reported errors for {input_path.name}: {err}")
+    else:
+        print(f"✔ Re-encoded: {input_path.name} → {output_path}")
+
+def decode_flac(job: Job, decoder_bin: str):
+    """Decode a FLAC file to a temporary WAV, ignoring decode errors. Returns True if a WAV was produced."""
+    input_path = job.input_path
+    job.wav_dir = tempfile.mkdtemp(prefix="rencodeFlac-")
+    wav_path = Path(job.wav_dir) / "decoded.wav"
+
+    decode_cmd = [decoder_bin, "-d", "-F", str(input_path), "-o", str(wav_path)]
+    rc, _, err = run_allow_errors(decode_cmd)
+    job.decode_rc = rc
+    if rc != 0:
+        print(f"⚠ Decode reported errors for {input_path.name}: {err}")
+    if not wav_path.exists():
+        print(f"❌ No WAV produced for {input_path.name}, skipping.")
+        return False
+    return True
+
+def encode_wav(job: Job, encode_cmd: list, verify: bool = True):
+    """Encode the temporary WAV of a decoded job, for encoders needing a seekable input."""
+    input_path, output_path = job.input_path, job.output_path
+    wav_path = Path(job.wav_dir) / "decoded.wav"
+    if verify:
+        job.decoded_md5 = wav_md5(wav_path)
+        job.source_md5 = streaminfo_md5(input_path)
+    rc, _, err = run_allow_errors(encode_cmd + [str(wav_path), "-o", str(job.part_path)])
+    job.encode_rc = rc
+    if rc != 0:
+        print(f"⚠ Encode reported errors for {input_path.name}: {err}")
+    else:
+        print(f"✔ Re-encoded: {input_path.name} → {output_path}")
+
+def iter_flac_files(in_dir: Path, recursive: bool, skip_dir: Path):
+    """Yield (path, stat) of the FLAC files in in_dir, as the directories are read."""
+    dirs = [in_dir]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and Path(entry.path) != skip_dir:
+                            dirs.append(entry.path)
+                    elif entry.name.endswith(".flac") and entry.is_file():
+                        yield Path(entry.path), entry.stat()
+        except OSError as e:
+            print(f"⚠ Cannot read directory: {e}")
+
+class Progress:
+    """Throughput and ETA of the finished jobs, the totals grow while files are discovered."""
+
+    def __init__(self):
+        self.total_files = 0
+        self.total_bytes = 0
+        self.discovering = True
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, job: Job):
+        with self.lock:
+            self.total_files += 1
+            self.total_bytes += job.size
+
+    def done(self, job: Job):
+        with self.lock:
+            self.files += 1
+            self.bytes += job.size
+            elapsed = max(time.monotonic() - self.start, 1e-6)
+            rate = self.bytes / elapsed
+            eta = (self.total_bytes - self.bytes) / rate if rate else 0
+            # The remaining work is unknown until the walk is over
+            eta = "?" if self.discovering else f"{int(eta // 60)}:{int(eta % 60):02}"
+            print(f"📊 {self.files}/{self.total_files}{'+' if self.discovering else ''} files, "
+                  f"{self.bytes / 1e6:.0f}/{self.total_bytes / 1e6:.0f} MB, "
+                  f"{rate / 1e6:.1f} MB/s, {self.files / elapsed:.2f} files/s, "
+                  f"ETA {eta}")
+
+class Scheduler:
+    """Run jobs in separate decode and encode pools.
+
+    When streaming, decoder and encoder of a job run together and the job only
+    takes an encode slot. Otherwise a decoded job is handed to the encode pool,
+    and the slots bound the decoded WAVs waiting for an encoder."""
+
+    def __init__(self, decoder_bin: str, encode_cmd: list, decode_workers: int, encode_workers: int,
+                 stream: bool, progress: Progress, journal: Journal, report: Report, verify: bool):
+        self.decoder_bin = decoder_bin
+        self.journal = journal
+        self.report = report
+        self.verify = verify
+        self.encode_cmd = encode_cmd
+        self.stream = stream
+        self.progress = progress
+        self.encode_pool = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix="encode")
+        self.decode_pool = None
+        self.max_slots = encode_workers
+        if not stream:
+            self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode")
+            self.max_slots += decode_workers
+        self.slots = threading.Semaphore(self.max_slots)
+
+    def submit(self, job: Job, block: bool = True):
+        """Start job, return False if block is False and no slot is free."""
+        if not self.slots.acquire(blocking=block):
+            return False
+        if self.stream:
+            self.encode_pool.submit(self._run, job, self._stream, job)
         else:
-            print(f"✔ Re-encoded: {input_path.name} → {output_path}")
+            self.decode_pool.submit(self._run, job, self._decode, job)
+        return True
+
+    def _decode(self, job: Job):
+        if job.digest is None:
+            job.digest = file_digest(job.input_path)
+        if not decode_flac(job, self.decoder_bin):
+            return True
+        self.encode_pool.submit(self._run, job, encode_wav, job, self.encode_cmd, self.verify)
+        # The encode stage finishes the job
+        return False
+
+    def _stream(self, job: Job):
+        if job.digest is None:
+            job.digest = file_digest(job.input_path)
+        reencode_flac(job, self.decoder_bin, self.encode_cmd, self.verify)
+
+    def _run(self, job: Job, stage, *args):
+        finished = True
+        try:
+            finished = stage(*args) is not False
+        except Exception as e:
+            print(f"❌ Error processing {job.input_path.name}: {e}")
+        finally:
+            if finished:
+                if job.wav_dir is not None:
+                    shutil.rmtree(job.wav_dir, ignore_errors=True)
+                try:
+                    finish_output(job)
+                    self.journal.record(job)
+                    self.report.add(job)
+                except Exception as e:
+                    print(f"❌ Error recording {job.input_path.name}: {e}")
+                self.progress.done(job)
+                self.slots.release()
+
+    def join(self):
+        for _ in range(self.max_slots):
+            self.slots.acquire()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+        self.encode_pool.shutdown()
 
 def main():
     examples = """Usage examples:
@@ -53,41 +528,79 @@ def main():
     parser.add_argument("-o", "--output", default="re-encode", help="Output directory for re-encoded FLAC files")
     parser.add_argument("--decoder-bin", default="flac", help="FLAC binary used for decoding")
     parser.add_argument("--encoder-bin", default="flac", help="FLAC binary used for encoding")
-    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of parallel threads")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of parallel encodes (default: CPU count / encoder threads)")
+    parser.add_argument("--decode-jobs", type=int, default=None,
+                        help="Number of parallel decodes with --temp-wav (default: half the encodes)")
+    parser.add_argument("--encoder-threads", type=int, default=1,
+                        help="Threads used by each encoder, passed as flac --threads (needs flac >= 1.5)")
+    parser.add_argument("--temp-wav", action="store_true",
+                        help="Decode to a temporary WAV file instead of piping, for encoders needing a seekable input")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Also process sub-directories, mirroring their structure in the output directory")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="Do not check the output STREAMINFO MD5 against the decoded samples, "
+                             "the decoder is then piped directly into the encoder")
+    parser.add_argument("--report", default=None,
+                        help="Write the summary report as JSON to this file")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-encode every file, even those the journal shows as already done")
     args = parser.parse_args()
 
     in_dir = Path(args.input).resolve()
     out_dir = Path(args.output).resolve()
     decoder_bin = args.decoder_bin
     encoder_bin = args.encoder_bin
-    threads = args.jobs
+    encode_workers = args.jobs or max(1, os.cpu_count() // args.encoder_threads)
+    decode_workers = args.decode_jobs or max(1, encode_workers // 2)
 
     if not in_dir.exists():
         raise FileNotFoundError(f"Input directory not found: {in_dir}")
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    flac_files = sorted(in_dir.glob("*.flac"))
-    if not flac_files:
-        print("No FLAC files found in:", in_dir)
-        return
-
-    print(f"Found {len(flac_files)} FLAC files.")
-    print(f"Using {threads} threads.")
+    if args.temp_wav:
+        print(f"Using {decode_workers} decode and {encode_workers} encode workers, "
+              f"{args.encoder_threads} thread(s) per encoder.")
+    else:
+        print(f"Using {encode_workers} workers, {args.encoder_threads} thread(s) per encoder.")
     print(f"Output directory: {out_dir}")
 
-    # --- parallel processing ---
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = {
-            executor.submit(reencode_flac, f, out_dir, decoder_bin, encoder_bin): f
-            for f in flac_files
-        }
-        for future in as_completed(futures):
-            file = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                print(f"❌ Error processing {file.name}: {e}")
+    journal = Journal(out_dir / JOURNAL_NAME)
+    progress = Progress()
+    report = Report()
+    scheduler = Scheduler(decoder_bin, encoder_cmd(encoder_bin, args.encoder_threads),
+                          decode_workers, encode_workers, not args.temp_wav, progress, journal,
+                          report, not args.no_verify)
+
+    # Jobs start as soon as a worker is free while the walk goes on, the ones
+    # waiting are started largest first so a huge file does not make the tail long
+    found = 0
+    pending = []
+    counter = itertools.count()
+    for f, st in iter_flac_files(in_dir, args.recursive, out_dir):
+        found += 1
+        rel = f.relative_to(in_dir)
+        job = Job(f, (out_dir / rel).with_suffix(".flac"), rel.as_posix(), st.st_size, st.st_mtime_ns)
+        if not args.force and journal.is_done(job):
+            continue
+        job.output_path.parent.mkdir(parents=True, exist_ok=True)
+        progress.add(job)
+        heapq.heappush(pending, (-job.size, next(counter), job))
+        while pending and scheduler.submit(pending[0][2], block=len(pending) >= ORDER_WINDOW):
+            heapq.heappop(pending)
+    progress.discovering = False
+    while pending:
+        scheduler.submit(heapq.heappop(pending)[2])
+    scheduler.join()
+    journal.close()
 
+    if not found:
+        print("No FLAC files found in:", in_dir)
+    else:
+        print(f"Found {found} FLAC files, {progress.total_files} new, changed or previously failed.")
+        report.print()
+        if args.report is not None:
+            report.write(Path(args.report))
     print("\nDone.")
 
 if __name__ == "__main__":
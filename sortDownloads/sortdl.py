@@ -4,32 +4,310 @@ import os
 import shutil
 import configparser
 import sys
-from tmdbv3api import TMDb, Movie, TV
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
-from guessit import guessit as parser
+import json
+import sqlite3
+import threading
+import time
+import errno
+import hashlib
+import ctypes
+import select
+import struct
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sanitize_filename import sanitize
 import logging
 import argparse
+# tmdbv3api, guessit and mutagen are slow to import, they are only imported once a video file needs them
 
 version = '1.1.0'
 
-# Set up TMDb API
-config = configparser.ConfigParser()
-config.read('config.ini')
-tmdb = TMDb()
-tmdb.api_key = config['API']['tmdb_api_key']
-tmdb.language = 'en'
+# Handlers are only set up when run as a script
+logger = logging.getLogger('sortdl')
 
-movie_api = Movie()
-tv_api = TV()
+COPY_BLOCK_SIZE = 1 << 23
+# Below this many file names to parse, a process pool costs more than it saves
+PARSE_POOL_MIN = 32
+
+def load_config(path='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+class TokenBucket:
+    """Allow rate calls per second on average, in bursts of at most burst calls"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Reserve the token now and wait for it outside of the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class TMDbClient:
+    """Rate limited TMDb requests.
+
+    api_base replaces the TMDb url, e.g. to run against a local fake server."""
+
+    def __init__(self, api_key, language='en', api_base=None, rate=40, burst=20):
+        from tmdbv3api import TMDb, Search, Season
+        tmdb = TMDb()
+        tmdb.api_key = api_key
+        tmdb.language = language
+        self.search_api = Search()
+        self.season_api = Season()
+        if api_base:
+            for api in (self.search_api, self.season_api):
+                api._base = api_base.rstrip('/')
+        self.bucket = TokenBucket(rate, burst)
+
+    @classmethod
+    def from_config(cls, config):
+        section = config['API']
+        return cls(section['tmdb_api_key'], section.get('language', 'en'), section.get('api_base'),
+                   float(section.get('rate_limit', 40)), int(section.get('burst', 20)))
+
+    def search_movie(self, title):
+        self.bucket.take()
+        return self.search_api.movies(title).results
+
+    def search_tvshow(self, title):
+        self.bucket.take()
+        return self.search_api.tv_shows(title).results
+
+    def season_details(self, show_id, season):
+        self.bucket.take()
+        return self.season_api.details(show_id, season, append_to_response='')
+
+class LookupCache:
+    """On disk cache of TMDb lookups.
+
+    Entries expire after ttl seconds, lookups that found nothing are cached too
+    (value None) for negative_ttl seconds, and the least recently used entries
+    are evicted above max_entries."""
+
+    def __init__(self, path, ttl, negative_ttl, max_entries):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, '
+                            'expires REAL, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            self.db.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        section = config['Cache'] if config.has_section('Cache') else {}
+        path = os.path.expanduser(section.get('path', '~/.cache/sortdl/tmdb.sqlite'))
+        day = 24 * 3600
+        return cls(path, float(section.get('ttl_days', 30)) * day,
+                   float(section.get('negative_ttl_days', 1)) * day,
+                   int(section.get('max_entries', 20000)))
+
+    def get(self, key):
+        """Return (hit, value), value being None for a cached negative result"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < now:
+                return False, None
+            self.db.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+            self.db.commit()
+        return True, json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                            (key, json.dumps(value), now + ttl, now))
+            self.db.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used DESC '
+                            'LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.db.commit()
+
+    def cached(self, key, fetch):
+        """Return the cached value of key, calling fetch() on a miss"""
+        hit, value = self.get(key)
+        if hit:
+            logger.debug(f"cache hit: {key}")
+            return value
+        value = fetch()
+        self.put(key, value)
+        return value
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# Writes are watched too, so that a download still in progress keeps being put off
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """Minimal inotify binding, watching whole trees"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+
+    def add_tree(self, folder):
+        for root, _, _ in os.walk(folder):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"Can't watch {root}: {os.strerror(errno)}")
+            self.paths[wd] = root
+
+    def read(self, timeout):
+        """Return the (path, mask) events, waiting at most timeout seconds for them"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_IGNORED:
+                # The folder is gone
+                self.paths.pop(wd, None)
+            elif wd in self.paths or mask & IN_Q_OVERFLOW:
+                events.append((os.path.join(self.paths.get(wd, ''), name), mask))
+        return events
+
+# Opened by sort_files when there is something to look up
+lookup_cache = None
 
 video_file_extensions = ['mp4', 'mkv', 'avi']
 audio_file_extensions = ['mp3', 'flac', 'alac', 'aac', 'aiff', 'wav']
 subtitle_file_extensions = ['srt', 'sub', 'stl']
 
+class Transfers:
+    """Moves files, renaming them when possible.
+
+    Moves to another filesystem are copied in the background, by jobs threads
+    per destination device, then the source is deleted. join() waits for them."""
+
+    def __init__(self, jobs=2, verify=False):
+        self.jobs = jobs
+        self.verify = verify
+        self.pools = {}
+        # Bounds the copies waiting in the pools
+        self.slots = threading.BoundedSemaphore(4 * jobs)
+        self.copies = []
+        self.folders = set()
+        self.moved = []
+        self.renamed = 0
+        self.copied_bytes = 0
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def move(self, src, dest):
+        folder = os.path.dirname(dest)
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            self.folders.add(folder)
+        try:
+            os.rename(src, dest)
+            self.moved.append(src)
+            self.renamed += 1
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        device = os.stat(folder).st_dev
+        if device not in self.pools:
+            self.pools[device] = ThreadPoolExecutor(max_workers=self.jobs)
+        self.slots.acquire()
+        future = self.pools[device].submit(self.copy, src, dest)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.copies.append((src, dest, future))
+
+    def copy(self, src, dest):
+        # Copied next to dest first, an interrupted copy never looks complete
+        part_path = dest + '.part'
+        try:
+            with open(src, 'rb') as fsrc, open(part_path, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                try:
+                    copied = 0
+                    while copied < size:
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                        if n == 0:
+                            break
+                        copied += n
+                except OSError as e:
+                    if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    shutil.copyfileobj(fsrc, fdst, COPY_BLOCK_SIZE)
+            shutil.copystat(src, part_path)
+            if self.verify and file_digest(src) != file_digest(part_path):
+                raise OSError(f"Copy of {src} doesn't match the source")
+        except BaseException:
+            # Don't leave a partial copy in the library (no space left, I/O error, interrupted)
+            if os.path.lexists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, dest)
+        os.remove(src)
+        with self.lock:
+            self.copied_bytes += size
+
+    def join(self):
+        """Wait for the copies and return the source files moved"""
+        for src, dest, future in self.copies:
+            try:
+                future.result()
+                self.moved.append(src)
+            except Exception as e:
+                logger.error(f"Error moving {src} to {dest}: {e}")
+        for pool in self.pools.values():
+            pool.shutdown()
+        if self.moved:
+            seconds = time.monotonic() - self.start
+            logger.info(f"{len(self.moved)} files moved ({self.renamed} renamed), "
+                        f"{self.copied_bytes / 1e6:.1f} MB copied in {seconds:.1f}s "
+                        f"({self.copied_bytes / 1e6 / max(seconds, 1e-3):.1f} MB/s)")
+        self.copies = []
+        return self.moved
+
+def file_digest(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        while block := f.read(COPY_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
 # Helper functions
-def move_file(src, dest, dry_run=False, ask_conf=False):
+def move_file(src, dest, dry_run=False, ask_conf=False, transfers=None):
     if dry_run:
         logger.info(f"\nDRY RUN\n{src} -->\n{dest}")
     else:
@@ -39,51 +317,84 @@ def move_file(src, dest, dry_run=False, ask_conf=False):
             if confirm != 'y':
                 execute = False
         if execute:
-            if not os.path.exists(os.path.dirname(dest)):
-                os.makedirs(os.path.dirname(dest))
-            shutil.move(src, dest)
+            if transfers is None:
+                if not os.path.exists(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.move(src, dest)
+            else:
+                try:
+                    transfers.move(src, dest)
+                except OSError as e:
+                    logger.error(f"Error moving {src} to {dest}: {e}")
+                    return
             logger.info(f"\n{src} ->\n{dest}")
 
-def find_movie_info(title, year=None):
+def normalize_title(title):
+    return ' '.join(str(title).lower().split())
+
+def find_movie_info(client, title, year=None):
+    return lookup_cache.cached(f"movie:{normalize_title(title)}:{year}",
+                               lambda: _find_movie_info(client, title, year))
+
+def _find_movie_info(client, title, year=None):
     logger.debug(f"searching for {title}")
-    search_result = movie_api.search(title)
-    for res in search_result.results:
+    results = client.search_movie(title)
+    for res in results:
         date = res['release_date'] if 'release_date' in res else ''
         logger.debug(f"found: {date} - {res['title']}")
-    if search_result.results:
+    if results:
         if year is not None:
-            for res in search_result.results:
+            for res in results:
                 if res['release_date'].split('-')[0] == str(year):
-                    return res
+                    return movie_fields(res)
 
-        return search_result.results[0]
+        return movie_fields(results[0])
     return None
 
-def find_tvshow_info(title):
-    search_result = tv_api.search(title)
-    if search_result.results:
-        return search_result.results[0]
+def movie_fields(res):
+    # Only what is needed, results are cached as json
+    return {'title': res['title'], 'release_date': res['release_date'] if 'release_date' in res else ''}
+
+def find_tvshow_info(client, title):
+    return lookup_cache.cached(f"tv:{normalize_title(title)}", lambda: _find_tvshow_info(client, title))
+
+def _find_tvshow_info(client, title):
+    results = client.search_tvshow(title)
+    if results:
+        res = results[0]
+        return {'id': res['id'], 'original_name': res['original_name']}
     return None
 
-def rename_and_move_movie(file_path, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False):
+def find_season_episodes(client, show_id, season):
+    """Return the episode names of a whole season by episode number, in one request"""
+    return lookup_cache.cached(f"season:{show_id}:{season}", lambda: _find_season_episodes(client, show_id, season))
+
+def _find_season_episodes(client, show_id, season):
+    details = client.season_details(show_id, season)
+    # Keys are strings as the result goes through json
+    return {str(ep['episode_number']): ep['name'] for ep in details['episodes']}
+
+def rename_and_move_movie(file_path, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False, transfers=None):
     file_name, file_ext = os.path.splitext(file_path)
     new_folder_name = sanitize(f"{movie_title} ({movie_year})")
     new_folder_path = os.path.join(dest_folder, new_folder_name)
     new_file_name = f"{new_folder_name}{file_ext}"
-    move_file(file_path, os.path.join(new_folder_path, new_file_name), dry_run, ask_conf)
+    move_file(file_path, os.path.join(new_folder_path, new_file_name), dry_run, ask_conf, transfers)
 
-def move_movie_subtitle(file_path, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False):
+def move_movie_subtitle(file_path, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False, transfers=None):
     new_folder_name = sanitize(f"{movie_title} ({movie_year})")
     new_folder_path = os.path.join(dest_folder, new_folder_name)
     filename = os.path.basename(file_path)
-    move_file(file_path, os.path.join(new_folder_path, filename), dry_run, ask_conf)
+    move_file(file_path, os.path.join(new_folder_path, filename), dry_run, ask_conf, transfers)
 
-def rename_and_move_tvshow(file_path, show_title, season_num, episode_num, episode_name, dest_folder, dry_run=False, ask_conf=False):
+def rename_and_move_tvshow(file_path, show_title, season_num, episode_nums, episode_name, dest_folder, dry_run=False, ask_conf=False, transfers=None):
     file_name, file_ext = os.path.splitext(file_path)
     season_folder = f"Season {int(season_num):02}"
-    episode_file_name = f"S{int(season_num):02}E{int(episode_num):02} - {sanitize(episode_name)}{file_ext}"
+    # Multi-episode files are named S01E01-E02
+    episodes = '-'.join(f"E{int(episode_num):02}" for episode_num in episode_nums)
+    episode_file_name = f"S{int(season_num):02}{episodes} - {sanitize(episode_name)}{file_ext}"
     season_folder = os.path.join(dest_folder, sanitize(show_title), season_folder)
-    move_file(file_path, os.path.join(season_folder, episode_file_name), dry_run, ask_conf)
+    move_file(file_path, os.path.join(season_folder, episode_file_name), dry_run, ask_conf, transfers)
 
 def file_is_video(extension):
     return extension.lower() in video_file_extensions
@@ -94,19 +405,17 @@ def file_is_audio(extension):
 def file_is_subtitle(extension):
     return extension.lower() in subtitle_file_extensions
 
-def get_subtitles_movie(movie_path, src_folder, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False):
-    folder = os.path.dirname(movie_path)
-    while folder != src_folder:
-        for root, dirs, files in os.walk(folder):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                file_ext = filename.split('.')[-1].lower()
-                if file_is_subtitle(file_ext):
-                    move_movie_subtitle(file_path, movie_title, movie_year, dest_folder, dry_run, ask_conf)
-        
-        folder = os.path.dirname(folder)
+def get_subtitles_movie(movie_path, index, movie_title, movie_year, dest_folder, dry_run=False, ask_conf=False, transfers=None):
+    # Subtitles anywhere in the download folder of the movie, if it has one
+    folder = index.top_folder(movie_path)
+    if folder is None:
+        return
+    for file_path in index.take_subtitles(folder):
+        move_movie_subtitle(file_path, movie_title, movie_year, dest_folder, dry_run, ask_conf, transfers)
 
 def delete_files(files_to_delete, dry_run=False, ask_conf=False):
+    """Delete files_to_delete and return the ones actually deleted"""
+    deleted = []
     for file in files_to_delete:
         if dry_run:
             logger.info(f"\nDRY RUN\n{file} -->\nThrash")
@@ -120,93 +429,386 @@ def delete_files(files_to_delete, dry_run=False, ask_conf=False):
                 try:
                     os.remove(file)
                     logger.info(f"\n{file} -->\nThrash")
+                    deleted.append(file)
                 except FileNotFoundError:
                     logger.error(f"File not found: {file}")
                 except PermissionError:
                     logger.error(f"Permission denied: {file}")
                 except Exception as e:
                     logger.error(f"Error deleting file {file}: {e}")
+    return deleted
 
-def _remove_empty_folders(folder, dry_run=False, ask_conf=False):
-    # Walk the directory tree from the bottom up (deepest subdirectories first)
-    for dirpath, dirnames, filenames in os.walk(folder, topdown=False):
-        # If the directory is empty (no files or subdirectories), remove it
-        if not dirnames and not filenames and not dirpath == folder:
-            if dry_run:
-                logger.info(f"\n{dirpath} -->\nThrash")
-            else:
-                execute = True
-                if ask_conf:
-                    confirm = input(f"{dirpath} -->\nThrash ?\n(y/n): ").lower()
-                    if confirm != 'y':
-                        execute = False
-                if execute:
-                    try:
-                        os.rmdir(dirpath)
-                        logger.info(f"\n{dirpath} -->\nThrash")
-                    except OSError as e:
-                        logger.error(f"Error removing folder {dirpath}: {e}")
-
-def remove_empty_folders(folder, dry_run=False, ask_conf=False):
-    # Execute twice as some empty folder could remain otherwise
-    _remove_empty_folders(folder, dry_run, ask_conf)
-    _remove_empty_folders(folder, dry_run, ask_conf)
-    
-# Main function to sort files
-def sort_files(src_folder, movie_dest, tv_dest, dry_run=False, ask_conf=False):
-    files_to_delete = []
-    for root, _, files in os.walk(src_folder):
+class SourceIndex:
+    """Folders and files of the source folder, from a single os.walk"""
+
+    def __init__(self, root):
+        self.root = root
+        self.parent = {}
+        self.children = {}
+        # Names of the files still in each folder
+        self.files = {}
+        self.subtitles = {}
+        self.audio = []
+        self.to_delete = []
+
+    def add(self, folder, dirnames, filenames):
+        self.children[folder] = [os.path.join(folder, dirname) for dirname in dirnames]
+        for child in self.children[folder]:
+            self.parent[child] = folder
+        self.files[folder] = set(filenames)
+
+    def add_subtitle(self, file_path):
+        self.subtitles.setdefault(os.path.dirname(file_path), []).append(file_path)
+
+    def removed(self, file_path):
+        self.files[os.path.dirname(file_path)].discard(os.path.basename(file_path))
+
+    def top_folder(self, file_path):
+        """Return the folder right below root containing file_path, None if it is directly in root"""
+        folder = os.path.dirname(file_path)
+        if folder == self.root:
+            return None
+        while self.parent[folder] != self.root:
+            folder = self.parent[folder]
+        return folder
+
+    def take_subtitles(self, folder):
+        """Return the subtitles in folder and its subfolders, only once"""
+        found = []
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            found.extend(self.subtitles.pop(folder, []))
+            stack.extend(self.children.get(folder, []))
+        return found
+
+    def folders_bottom_up(self):
+        folders = []
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            folders.append(folder)
+            stack.extend(self.children.get(folder, []))
+        return reversed(folders)
+
+def remove_empty_folders(index, dry_run=False, ask_conf=False):
+    # Subfolders come first, so a single pass also removes the folders left empty by it
+    removed = set()
+    for dirpath in index.folders_bottom_up():
+        # Folders that weren't walked (symlinks) are never removed
+        if dirpath == index.root or dirpath not in index.files:
+            continue
+        if index.files[dirpath] or not all(child in removed for child in index.children[dirpath]):
+            continue
+        if dry_run:
+            logger.info(f"\n{dirpath} -->\nThrash")
+            removed.add(dirpath)
+        else:
+            execute = True
+            if ask_conf:
+                confirm = input(f"{dirpath} -->\nThrash ?\n(y/n): ").lower()
+                if confirm != 'y':
+                    execute = False
+            if execute:
+                try:
+                    os.rmdir(dirpath)
+                    logger.info(f"\n{dirpath} -->\nThrash")
+                    removed.add(dirpath)
+                except OSError as e:
+                    logger.error(f"Error removing folder {dirpath}: {e}")
+
+def read_audio_tags(file_path):
+    """Return the (artist, album) tags of an audio file, None if it has none.
+
+    mutagen only parses the tags and stream headers, not the audio data."""
+    from mutagen import File, MutagenError
+    try:
+        audio = File(file_path, easy=True)
+    except MutagenError:
+        return None
+    if audio is None or audio.tags is None:
+        return None
+    artist = audio.tags.get('albumartist') or audio.tags.get('artist')
+    album = audio.tags.get('album')
+    if not artist or not album:
+        return None
+    return artist[0], album[0]
+
+def sort_audio(audio_paths, music_dest, dry_run=False, ask_conf=False, transfers=None, jobs=8):
+    """Move the tagged audio files to music_dest/artist/album, a whole album at a time"""
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        tags = pool.map(read_audio_tags, audio_paths)
+        albums = {}
+        for file_path, album_tags in zip(audio_paths, tags):
+            if album_tags is None:
+                logger.warning(f"\nNo artist or album tag in '{os.path.basename(file_path)}', skipping\n")
+                continue
+            albums.setdefault(album_tags, []).append(file_path)
+
+    for (artist, album), tracks in albums.items():
+        album_folder = os.path.join(music_dest, sanitize(artist), sanitize(album))
+        names = set()
+        for file_path in tracks:
+            name = os.path.basename(file_path)
+            if name in names:
+                # Same track names on several discs, keep them apart with the disc folder name
+                name = f"{os.path.basename(os.path.dirname(file_path))} - {name}"
+            names.add(name)
+            move_file(file_path, os.path.join(album_folder, name), dry_run, ask_conf, transfers)
+
+def parse_name(filename):
+    """guessit filename, keeping only the fields used (the result is cached as json)"""
+    from guessit import guessit
+    try:
+        parsed = guessit(filename)
+    except Exception:
+        return None
+    return {key: parsed[key] for key in ('title', 'year', 'season', 'episode') if key in parsed}
+
+def parse_names(filenames):
+    """Return the parse_name results by file name, from the cache or from a process pool"""
+    parsed = {}
+    missing = []
+    for filename in set(filenames):
+        hit, value = lookup_cache.get(f"guessit:{filename}")
+        if hit:
+            parsed[filename] = value
+        else:
+            missing.append(filename)
+    if len(missing) < PARSE_POOL_MIN:
+        results = map(parse_name, missing)
+    else:
+        with ProcessPoolExecutor() as pool:
+            results = list(pool.map(parse_name, missing, chunksize=16))
+    for filename, value in zip(missing, results):
+        lookup_cache.put(f"guessit:{filename}", value)
+        parsed[filename] = value
+    return parsed
+
+def collect_files(src_folder, top_paths=None):
+    """Walk src_folder once, list the video files and index everything else.
+
+    top_paths limits the walk to these entries of src_folder."""
+    video_paths = []
+    index = SourceIndex(src_folder)
+    if top_paths is None:
+        walk = os.walk(src_folder)
+    else:
+        dirs = [path for path in top_paths if os.path.isdir(path) and not os.path.islink(path)]
+        files = [os.path.basename(path) for path in top_paths if path not in dirs]
+        walk = itertools.chain([(src_folder, [os.path.basename(path) for path in dirs], files)],
+                               *(os.walk(path) for path in dirs))
+    for root, dirs, files in walk:
+        index.add(root, dirs, files)
         for filename in files:
             file_path = os.path.join(root, filename)
             file_ext = filename.split('.')[-1].lower()
 
             if not file_is_video(file_ext) and not file_is_audio(file_ext) and not file_is_subtitle(file_ext):
-                files_to_delete.append(file_path)
+                index.to_delete.append(file_path)
                 continue
-            
+
+            if file_is_subtitle(file_ext):
+                index.add_subtitle(file_path)
+
             if file_is_video(file_ext):
-                try:
-                    parsed = parser(filename)
-                    parsed_title = parsed['title']
-                    if 'year' in parsed:
-                        parsed_year = parsed['year']
-                    else:
-                        parsed_year = None
-                    
-                except:
-                    logger.error(f"Couldn't parse : {filename}")
-                    continue
-
-                
-                if 'season' in parsed and 'episode' in parsed:
-                    # Handle TV show episode
-                    res = find_tvshow_info(parsed_title)
-                    if not res:
-                        logger.warning(f"\nNo result found for '{filename}', skipping\n")
-                        continue
-                    show_id = res['id']
-                    show_title = res['original_name']
-                    season = parsed['season']
-                    episode = parsed['episode']
-                    episode_title = tv_api.details(f"{show_id}/season/{season}/episode/{episode}")['name']
-                    rename_and_move_tvshow(file_path, show_title, season, episode, episode_title, tv_dest, dry_run, ask_conf)
-                    # TV shows subtitles are not handled as too painful
-                    
-                else:
-                    # Handle movies
-                    res = find_movie_info(parsed_title, year=parsed_year)
-                    if not res:
-                        logger.warning(f"\nNo result found for '{filename}', skipping\n")
-                        continue
-                    movie_title = res['title']
-                    movie_year = res['release_date'].split('-')[0]
-                    rename_and_move_movie(file_path, movie_title, movie_year, movie_dest, dry_run, ask_conf)
-                    get_subtitles_movie(file_path, src_folder, movie_title, movie_year, movie_dest, dry_run, ask_conf)
-
-            # TODO Treat audio files
-    
-    delete_files(files_to_delete, dry_run, ask_conf)
-    remove_empty_folders(src_folder, dry_run, ask_conf)
+                video_paths.append(file_path)
+
+            if file_is_audio(file_ext):
+                index.audio.append(file_path)
+    return video_paths, index
+
+def parse_videos(video_paths):
+    """Return the (file_path, parsed) of the video files that could be parsed"""
+    parsed_names = parse_names(os.path.basename(file_path) for file_path in video_paths)
+    videos = []
+    for file_path in video_paths:
+        filename = os.path.basename(file_path)
+        parsed = parsed_names[filename]
+        if not parsed or 'title' not in parsed:
+            logger.error(f"Couldn't parse : {filename}")
+            continue
+        if is_episode(parsed):
+            numbers = episode_numbers(parsed)
+            if numbers is None:
+                logger.error(f"Couldn't parse episode number: {filename}")
+                continue
+            parsed = dict(parsed, season=numbers[0], episode=numbers[1])
+        videos.append((file_path, parsed))
+    return videos
+
+def is_episode(parsed):
+    return 'season' in parsed and 'episode' in parsed
+
+def episode_numbers(parsed):
+    """Return (season, [episodes]), guessit gives a list of episodes for multi-episode files"""
+    season = parsed['season']
+    episodes = parsed['episode']
+    if isinstance(season, list):
+        # Several seasons in one file, can't be named
+        return None
+    if not isinstance(episodes, list):
+        episodes = [episodes]
+    try:
+        return int(season), sorted({int(episode) for episode in episodes})
+    except (TypeError, ValueError):
+        return None
+
+def resolve(client, videos, jobs):
+    """Look up every distinct movie, show and episode once, jobs at a time.
+
+    Return the lookup results by key, see movie_key, show_key and season_key."""
+    results = {}
+
+    def lookup(call):
+        try:
+            return call[0](client, *call[1:])
+        except Exception as e:
+            logger.error(f"Lookup failed for {call[1:]}: {e}")
+            return None
+
+    def lookup_all(lookups):
+        # lookups maps each key to a (function, *args) call
+        results.update(zip(lookups, pool.map(lookup, lookups.values())))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        lookups = {}
+        for _, parsed in videos:
+            if is_episode(parsed):
+                lookups[show_key(parsed)] = (find_tvshow_info, parsed['title'])
+            else:
+                lookups[movie_key(parsed)] = (find_movie_info, parsed['title'], parsed.get('year'))
+        lookup_all(lookups)
+
+        # Episodes need the show id first, and are fetched a whole season at a time
+        lookups = {}
+        for _, parsed in videos:
+            show = results[show_key(parsed)] if is_episode(parsed) else None
+            if show:
+                lookups[season_key(show, parsed)] = (find_season_episodes, show['id'], parsed['season'])
+        lookup_all(lookups)
+    return results
+
+def movie_key(parsed):
+    return ('movie', normalize_title(parsed['title']), parsed.get('year'))
+
+def show_key(parsed):
+    return ('tv', normalize_title(parsed['title']))
+
+def season_key(show, parsed):
+    return ('season', show['id'], parsed['season'])
+
+# Main function to sort files
+def sort_files(src_folder, movie_dest, tv_dest, dry_run=False, ask_conf=False, config=None, client=None, jobs=8,
+               top_paths=None, copy_jobs=2, verify=False, music_dest=None):
+    global lookup_cache
+    # Walk and parse everything, then query TMDb concurrently, then move
+    video_paths, index = collect_files(src_folder, top_paths)
+    videos = []
+    if video_paths:
+        config = config or load_config()
+        if lookup_cache is None:
+            lookup_cache = LookupCache.from_config(config)
+        client = client or TMDbClient.from_config(config)
+        videos = parse_videos(video_paths)
+    results = resolve(client, videos, jobs)
+    transfers = Transfers(copy_jobs, verify)
+
+    for file_path, parsed in videos:
+        filename = os.path.basename(file_path)
+        if is_episode(parsed):
+            # Handle TV show episode
+            res = results[show_key(parsed)]
+            if not res:
+                logger.warning(f"\nNo result found for '{filename}', skipping\n")
+                continue
+            show_title = res['original_name']
+            season = parsed['season']
+            episodes = parsed['episode']
+            names = results[season_key(res, parsed)] or {}
+            if not all(str(episode) in names for episode in episodes):
+                logger.warning(f"\nNo episode title found for '{filename}', skipping\n")
+                continue
+            episode_title = ' & '.join(names[str(episode)] for episode in episodes)
+            rename_and_move_tvshow(file_path, show_title, season, episodes, episode_title, tv_dest, dry_run, ask_conf,
+                                   transfers)
+            # TV shows subtitles are not handled as too painful
+
+        else:
+            # Handle movies
+            res = results[movie_key(parsed)]
+            if not res:
+                logger.warning(f"\nNo result found for '{filename}', skipping\n")
+                continue
+            movie_title = res['title']
+            movie_year = res['release_date'].split('-')[0]
+            rename_and_move_movie(file_path, movie_title, movie_year, movie_dest, dry_run, ask_conf, transfers)
+            get_subtitles_movie(file_path, index, movie_title, movie_year, movie_dest, dry_run, ask_conf, transfers)
+
+    # Audio files are left in place without a music library
+    if music_dest and index.audio:
+        sort_audio(index.audio, music_dest, dry_run, ask_conf, transfers, jobs)
+
+    for file_path in transfers.join():
+        index.removed(file_path)
+
+    for file_path in delete_files(index.to_delete, dry_run, ask_conf):
+        index.removed(file_path)
+    remove_empty_folders(index, dry_run, ask_conf)
+
+def watch(src_folder, movie_dest, tv_dest, settle, dry_run=False, ask_conf=False, **options):
+    """Sort src_folder, then sort again what changes in it.
+
+    Entries right below src_folder are handled once nothing was written in them
+    for settle seconds, and only their subtree is walked."""
+
+    def sort(top_paths=None):
+        # A failure must not end the watch, the entries are tried again on their next change
+        try:
+            sort_files(src_folder, movie_dest, tv_dest, dry_run, ask_conf, top_paths=top_paths, **options)
+        except Exception as e:
+            logger.error(f"Error sorting {src_folder}: {e}")
+
+    def add_tree(folder):
+        try:
+            inotify.add_tree(folder)
+        except OSError as e:
+            # Gone already, or out of watches (fs.inotify.max_user_watches)
+            logger.error(f"{e}")
+
+    inotify = Inotify()
+    inotify.add_tree(src_folder)
+    sort()
+    logger.info(f"Watching {src_folder}")
+    # Last activity by entry of src_folder, src_folder itself meaning everything
+    pending = {}
+    while True:
+        timeout = None
+        if pending:
+            # The full pass would also take the entries still being written, wait for all of them
+            last = max(pending.values()) if src_folder in pending else min(pending.values())
+            timeout = max(0, last + settle - time.monotonic())
+        for path, mask in inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                top = src_folder
+            else:
+                top = os.path.join(src_folder, os.path.relpath(path, src_folder).split(os.sep)[0])
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    add_tree(path)
+            pending[top] = time.monotonic()
+
+        now = time.monotonic()
+        if src_folder in pending:
+            if all(now - last >= settle for last in pending.values()):
+                pending.clear()
+                sort()
+            continue
+        ready = [top for top, last in pending.items() if now - last >= settle]
+        for top in ready:
+            del pending[top]
+        if ready:
+            sort([top for top in ready if os.path.lexists(top)])
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(description='Search for media files in download folder and sort them out')
@@ -215,12 +817,16 @@ if __name__ == '__main__':
     argparser.add_argument('tv_dest', type=str, help='Folder containing TV Shows library')
     argparser.add_argument('-c', '--confirmation', action='store_true', default=False, help='Request confirmation from user for each file move or delete')
     argparser.add_argument('-d', '--dryrun', action='store_true', default=False, help='Dry run, only display what would have been moved and deleted')
+    argparser.add_argument('-m', '--music-dest', type=str, help='Folder containing Music library, audio files are sorted into it by artist and album')
+    argparser.add_argument('-j', '--jobs', type=int, default=8, help='Number of concurrent TMDb lookups and audio tag reads (default: 8)')
+    argparser.add_argument('--copy-jobs', type=int, default=2, help='Number of parallel copies per destination disk, for moves across filesystems (default: 2)')
+    argparser.add_argument('--verify', action='store_true', default=False, help='Check copies across filesystems against the source before deleting it')
+    argparser.add_argument('-w', '--watch', action='store_true', default=False, help='Keep running and sort new downloads as they complete')
+    argparser.add_argument('--settle', type=float, default=60, help='In watch mode, seconds without writes before a download is sorted (default: 60)')
     argparser.add_argument('-v', '--version', action='version', version=version)
     argparser.add_argument('--debug', action='store_true', help='Enable debug mode')
     args = argparser.parse_args()
 
-    logger = logging.getLogger('sortdl')
-
     if args.debug:
         logger.setLevel(logging.DEBUG)
     else:
@@ -243,5 +849,13 @@ if __name__ == '__main__':
     dry_run = args.dryrun
     ask_conf = args.confirmation
 
-    sort_files(source_folder, movies_folder, tv_shows_folder, dry_run=dry_run, ask_conf=ask_conf)
+    options = {'jobs': args.jobs, 'copy_jobs': args.copy_jobs, 'verify': args.verify,
+               'music_dest': os.path.abspath(args.music_dest) if args.music_dest else None}
+    if args.watch:
+        try:
+            watch(source_folder, movies_folder, tv_shows_folder, args.settle, dry_run=dry_run, ask_conf=ask_conf, **options)
+        except KeyboardInterrupt:
+            pass
+    else:
+        sort_files(source_folder, movies_folder, tv_shows_folder, dry_run=dry_run, ask_conf=ask_conf, **options)
     sys.exit(0)
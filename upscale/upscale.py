@@ -3,7 +3,19 @@
 import argparse
 import os
 import glob
+import hashlib
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import shutil
+import tempfile
+import time
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image as img
+from PIL import ImageDraw
 import subprocess
 
 img.MAX_IMAGE_PIXELS = 492000000
@@ -25,6 +37,11 @@ models = {
     '4xLSDIRplusC': __custom_model_path__,
 }
 
+CACHE_NAME = '.upscale-cache.json'
+COMPARISON_NAME = 'upscale-comparison.json'
+# Size of the cells of the comparison contact sheet
+PREVIEW_SIZE = 384
+
 class CommandExecutionError(Exception):
     pass
 
@@ -33,7 +50,16 @@ def existing_path(string):
         raise argparse.ArgumentTypeError(repr(string) + " not found.")
     return os.path.abspath(string)
 
-def convert_jpg_to_png(input_file, output_file=None):
+def default_tmp_dir():
+    """RAM backed folder when available, intermediate files never hit the disk"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def upscaled_name(input_file, model_name, scale):
+    return os.path.splitext(input_file)[0] + '_' + model_name + '_x' + str(scale)
+
+def convert_jpg_to_png(input_file, output_file=None, compress_level=6):
     print(f'Converting {input_file} to png')
     if output_file is None:
         output_file = os.path.splitext(input_file)[0] + '.png'
@@ -44,21 +70,24 @@ def convert_jpg_to_png(input_file, output_file=None):
 
     try:
         image = img.open(input_file)
-        image.save(output_file, format="PNG")
+        image.save(output_file, format="PNG", compress_level=compress_level)
         print(f'Saved png as {output_file}')
         return output_file
     except Exception as e:
         print(f'Error during conversion: {e}')
         raise e
 
-def upscale(input_file, output_file=None, scale=4, model_path=__model_path__, model_name='ultrasharp'):
+def upscale(input_file, output_file=None, scale=4, model_path=__model_path__, model_name='ultrasharp',
+            upscayl_bin=__upscayl__, gpu_id=None):
     print(f'Upscaling {input_file}')
     if output_file is None:
-        output_file = os.path.splitext(input_file)[0] + '_' + model_name + '_x' + str(scale) + '.png'
+        output_file = upscaled_name(input_file, model_name, scale) + '.png'
 
-    result = subprocess.run([__upscayl__, '-i', input_file, '-s', str(scale), '-m', model_path,
-                             '-n', model_name, '-o', output_file],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) 
+    cmd = [upscayl_bin, '-i', input_file, '-s', str(scale), '-m', model_path,
+           '-n', model_name, '-o', output_file]
+    if gpu_id is not None:
+        cmd += ['-g', str(gpu_id)]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
     if result.returncode == 0:
         print(f'Saved upscaled as {output_file}')
@@ -69,39 +98,471 @@ def upscale(input_file, output_file=None, scale=4, model_path=__model_path__, mo
         error_message += f'STDERR: {result.stderr}'
         raise CommandExecutionError(error_message)
 
-def compress(input_file, output_file=None, quality=50):
+def compress(input_file, output_file=None, quality=50, preview=False):
+    """Compress input_file to jpg.
+
+    With preview, returns (output_file, thumbnail, crop) instead of output_file,
+    the previews being made from the decoded image before it is closed."""
     print(f'Compressing {input_file}')
     if output_file is None:
         output_file = os.path.splitext(input_file)[0] + '.jpg'
 
-    image = img.open(input_file)
-    image.convert('RGB').save(output_file, 'JPEG', quality=quality)
+    with img.open(input_file) as image:
+        # convert() makes a full copy of the image, only do it when JPEG cannot take the mode
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output_file, 'JPEG', quality=quality)
+        if preview:
+            (thumbnail, crop) = previews(image)
 
     print(f'Saved compressed file as {output_file}')
+    if preview:
+        return output_file, thumbnail, crop
     return output_file
 
+def reset_peak_rss():
+    """Reset the peak RSS of this process, Linux only"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    """Peak RSS of this process in bytes, since the last reset_peak_rss() on Linux"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def center_box(size, crop_size):
+    (w, h) = size
+    (cw, ch) = (min(crop_size, w), min(crop_size, h))
+    return ((w - cw) // 2, (h - ch) // 2, (w - cw) // 2 + cw, (h - ch) // 2 + ch)
+
+def previews(image):
+    """Center crop at full resolution and thumbnail of image, the thumbnail is made in place.
+
+    Meant for an image already decoded, the crop needs the full resolution."""
+    crop = image.crop(center_box(image.size, PREVIEW_SIZE))
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    return image.copy(), crop
+
+def compress_measured(input_file, output_file=None, quality=50, preview=False):
+    """compress() run in a worker process.
+
+    Returns a dict with the output, the peak RSS and time it needed, and with
+    preview the thumbnail and center crop of the image, made by compress()
+    while it is still decoded."""
+    reset_peak_rss()
+    start = time.monotonic()
+    result = {}
+    if preview:
+        (output_file, result['thumbnail'], result['crop']) = compress(input_file, output_file, quality, True)
+    else:
+        output_file = compress(input_file, output_file, quality)
+    result['output'] = output_file
+    result['compress_seconds'] = time.monotonic() - start
+    result['peak_rss'] = peak_rss()
+    return result
+
+class OutputCache:
+    """Outputs already produced, keyed by input content, model name, model path and scale.
+
+    Stored as json next to the inputs. An input is only hashed again if its
+    size or mtime changed, and an output is only trusted if it still has the
+    size and mtime recorded, so a re-run over finished work is only stats."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.inputs = {}
+        self.outputs = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.inputs = data.get('inputs', {})
+            self.outputs = data.get('outputs', {})
+
+    def digest(self, file):
+        st = os.stat(file)
+        with self.lock:
+            entry = self.inputs.get(file)
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            return entry['digest']
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        with self.lock:
+            self.inputs[file] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': h.hexdigest()}
+        return h.hexdigest()
+
+    @staticmethod
+    def key(digest, model_name, model_path, scale):
+        return hashlib.sha256(json.dumps([digest, model_name, model_path, str(scale)]).encode()).hexdigest()
+
+    def lookup(self, key):
+        """Return the output recorded for key if it is still the one produced, None otherwise"""
+        with self.lock:
+            entry = self.outputs.get(key)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(entry['path'])
+        except OSError:
+            return None
+        if (entry['size'], entry['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            return None
+        return entry['path']
+
+    def add(self, key, output_file):
+        st = os.stat(output_file)
+        with self.lock:
+            self.outputs[key] = {'path': output_file, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def output_files(self):
+        with self.lock:
+            return {entry['path'] for entry in self.outputs.values()}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'inputs': self.inputs, 'outputs': self.outputs}, indent=1)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+def is_output(file):
+    """Whether file looks like one of our outputs, <name>_<model or comparison>_x<scale>.<ext>"""
+    base = os.path.splitext(os.path.basename(file))[0]
+    names = [re.escape(model) for model in models] + ['comparison']
+    return re.search('_(' + '|'.join(names) + r')_x\d+$', base) is not None
+
+class Comparison:
+    """Contact sheet and timings of every model, for each input of --all.
+
+    The thumbnails and crops come from the compression workers while the
+    images are decoded, only outputs reused from the cache are decoded again."""
+
+    def __init__(self, model_names, scale, report_path):
+        self.model_names = model_names
+        self.scale = int(scale)
+        self.report_path = report_path
+        self.lock = threading.Lock()
+        self.results = {}
+        self.report = {}
+        if os.path.exists(report_path):
+            with open(report_path, 'r') as f:
+                self.report = json.load(f).get('images', {})
+
+    def add(self, file, model, stats):
+        with self.lock:
+            self.results.setdefault(file, {})[model] = stats
+
+    def finish(self, file):
+        """Write the contact sheet of file once every model is done"""
+        with self.lock:
+            results = self.results.pop(file, {})
+        stats = self.report.setdefault(file, {})
+        for model in self.model_names:
+            result = results.get(model)
+            if result is None:
+                output = upscaled_name(file, model, self.scale) + '.jpg'
+                if not os.path.exists(output):
+                    continue
+                # Reused from the cache, only previews are missing
+                with img.open(output) as image:
+                    (thumbnail, crop) = previews(image)
+                result = {'output': output, 'thumbnail': thumbnail, 'crop': crop}
+            else:
+                stats[model] = {key: result[key] for key in ('upscale_seconds', 'compress_seconds', 'peak_rss')}
+                stats[model]['wall_seconds'] = result['upscale_seconds'] + result['compress_seconds']
+                stats[model]['output_size'] = os.path.getsize(result['output'])
+            results[model] = result
+
+        with img.open(file) as source:
+            source = source.convert('RGB')
+            box = center_box((source.width * self.scale, source.height * self.scale), PREVIEW_SIZE)
+            source_crop = source.crop(tuple(v // self.scale for v in box))
+            source_crop = source_crop.resize((box[2] - box[0], box[3] - box[1]), img.NEAREST)
+            # Fit the source in the same cell as the outputs, it is usually smaller
+            ratio = PREVIEW_SIZE / max(source.size)
+            source = source.resize((round(source.width * ratio), round(source.height * ratio)), img.LANCZOS)
+            columns = [('source', source, source_crop)]
+        columns += [(model, results[model]['thumbnail'], results[model]['crop'])
+                    for model in self.model_names if model in results]
+
+        label = 20
+        sheet = img.new('RGB', (len(columns) * PREVIEW_SIZE, 2 * (PREVIEW_SIZE + label)), 'white')
+        draw = ImageDraw.Draw(sheet)
+        for (i, (name, thumbnail, crop)) in enumerate(columns):
+            x = i * PREVIEW_SIZE
+            draw.text((x + 4, 4), name, fill='black')
+            sheet.paste(thumbnail, (x, label))
+            sheet.paste(crop, (x, 2 * label + PREVIEW_SIZE))
+        sheet_file = upscaled_name(file, 'comparison', self.scale) + '.jpg'
+        sheet.save(sheet_file, 'JPEG', quality=85)
+        print(f'Saved comparison sheet as {sheet_file}')
+
+    def save(self):
+        """Write the per image statistics and print the per model summary"""
+        summary = {}
+        for stats in self.report.values():
+            for (model, s) in stats.items():
+                total = summary.setdefault(model, {'images': 0, 'wall_seconds': 0, 'output_size': 0})
+                total['images'] += 1
+                total['wall_seconds'] += s['wall_seconds']
+                total['output_size'] += s['output_size']
+        with open(self.report_path, 'w') as f:
+            json.dump({'images': self.report, 'models': summary}, f, indent=1)
+        print('Model comparison (mean per image):')
+        for (model, total) in summary.items():
+            print(f'  {model}: {total["wall_seconds"] / total["images"]:.1f} s, '
+                  f'{total["output_size"] / total["images"] / 2**20:.1f} MB ({total["images"]} images)')
+
+class MemoryBudget:
+    """Bound the estimated memory of the upscale and compress jobs running at the same time"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            # A job bigger than the limit is let through alone
+            self.cond.wait_for(lambda: self.in_use == 0 or self.in_use + n <= self.limit)
+            self.in_use += n
+
+    def release(self, n):
+        with self.cond:
+            self.in_use -= n
+            self.cond.notify_all()
+
+def then(future, executor, fn, *args, **kwargs):
+    """Run fn(result of future, *args) in executor once future is done, return its future"""
+    chained = Future()
+
+    def forward(done):
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+        else:
+            chained.set_result(done.result())
+
+    def submit(done):
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+            return
+        executor.submit(fn, done.result(), *args, **kwargs).add_done_callback(forward)
+
+    future.add_done_callback(submit)
+    return chained
+
+class Pipeline:
+    """Convert, upscale and compress several files at once, one pool per stage.
+
+    While the upscaler runs on a file, the next ones are converted and the
+    previous ones compressed. The number of files in flight is bounded so
+    conversion does not run far ahead of the upscaler.
+
+    Unless keep_intermediates is set, the png files are written uncompressed
+    in a folder of tmp_dir and removed as soon as they are no longer needed,
+    only the final jpg is written next to the input."""
+
+    def __init__(self, convert_jobs=1, upscale_jobs=1, compress_jobs=1,
+                 upscayl_bin=__upscayl__, gpu_id=None, tmp_dir=None, keep_intermediates=False,
+                 memory_limit=None):
+        self.convert_pool = ThreadPoolExecutor(max_workers=convert_jobs, thread_name_prefix='convert')
+        self.upscale_pool = ThreadPoolExecutor(max_workers=upscale_jobs, thread_name_prefix='upscale')
+        self.compress_pool = ThreadPoolExecutor(max_workers=compress_jobs, thread_name_prefix='compress')
+        # Compression runs in worker processes, so the memory of a huge image is given
+        # back once it is done and its peak RSS can be measured. spawn, as forking a
+        # process running threads is not safe
+        self.compress_procs = ProcessPoolExecutor(max_workers=compress_jobs,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        self.peaks = []
+        self.memory = MemoryBudget(memory_limit) if memory_limit else None
+        self.upscayl_bin = upscayl_bin
+        self.gpu_id = gpu_id
+        self.work_dir = None
+        if not keep_intermediates:
+            self.work_dir = tempfile.mkdtemp(prefix='upscale-', dir=tmp_dir or default_tmp_dir())
+        self.in_flight = threading.Semaphore(convert_jobs + upscale_jobs + compress_jobs)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.errors = []
+
+    def intermediate(self, file, suffix):
+        """Path of an intermediate file, next to file if they are kept"""
+        if self.work_dir is None:
+            return os.path.splitext(file)[0] + suffix
+        return os.path.join(self.work_dir, os.path.splitext(os.path.basename(file))[0] + suffix)
+
+    def discard(self, path):
+        if self.work_dir is not None and path.startswith(self.work_dir + os.sep):
+            os.remove(path)
+
+    def upscale(self, png_file, output_file, scale, model, timings):
+        cost = 0
+        if self.memory is not None:
+            # upscayl holds the input and the upscaled output, estimated as RGBA
+            with img.open(png_file) as image:
+                cost = image.width * image.height * (1 + int(scale) ** 2) * 4
+            self.memory.acquire(cost)
+        try:
+            start = time.monotonic()
+            upscaled = upscale(png_file, output_file, scale=scale, model_name=model, model_path=models[model],
+                               upscayl_bin=self.upscayl_bin, gpu_id=self.gpu_id)
+            timings[model] = time.monotonic() - start
+            return upscaled
+        finally:
+            if self.memory is not None:
+                self.memory.release(cost)
+
+    def compress(self, upscaled_file, output_file, preview=False):
+        cost = 0
+        if self.memory is not None:
+            # The decoded image, and the RGB copy of compress() when JPEG cannot take its mode
+            with img.open(upscaled_file) as image:
+                cost = image.width * image.height * len(image.getbands())
+                if image.mode not in ('RGB', 'L'):
+                    cost += image.width * image.height * 3
+            self.memory.acquire(cost)
+        try:
+            result = self.compress_procs.submit(compress_measured, upscaled_file, output_file,
+                                                preview=preview).result()
+        finally:
+            if self.memory is not None:
+                self.memory.release(cost)
+            self.discard(upscaled_file)
+        print(f'Peak RSS compressing {result["output"]}: {result["peak_rss"] / 2**20:.0f} MB')
+        with self.lock:
+            self.peaks.append(result['peak_rss'])
+        return result
+
+    def submit(self, file, model_names, scale, output_file=None, on_done=None, on_finished=None,
+               preview=False):
+        """Queue file to be upscaled with every model of model_names.
+
+        on_done(model, stats) is called for each model that succeeded, stats
+        holding the output and timings, and the thumbnail and crop with
+        preview. on_finished() is called once every model is done."""
+        self.in_flight.acquire()
+        compress_level = 6 if self.work_dir is None else 0
+        png_future = self.convert_pool.submit(convert_jpg_to_png, file, self.intermediate(file, '.png'),
+                                              compress_level)
+        futures = []
+        timings = {}
+        for model in model_names:
+            name = upscaled_name(file, model, scale)
+            upscaled = then(png_future, self.upscale_pool, self.upscale, self.intermediate(name, '.png'),
+                            scale, model, timings)
+            futures.append(then(upscaled, self.compress_pool, self.compress, output_file or name + '.jpg',
+                                preview))
+        remaining = [len(futures)]
+
+        def done(future, model):
+            if future.exception() is not None:
+                print(f'Error processing {file} with {model}: {future.exception()}')
+                with self.lock:
+                    self.errors.append((file, model, future.exception()))
+            elif on_done is not None:
+                on_done(model, dict(future.result(), upscale_seconds=timings[model]))
+            with self.lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                if png_future.exception() is None:
+                    self.discard(png_future.result())
+                try:
+                    if on_finished is not None:
+                        on_finished()
+                except Exception as e:
+                    print(f'Error finishing {file}: {e}')
+                finally:
+                    self.in_flight.release()
+
+        for (future, model) in zip(futures, model_names):
+            future.add_done_callback(lambda future, model=model: done(future, model))
+        self.pending += futures
+
+    def join(self):
+        """Wait for every file, return the list of (file, model, error) that failed"""
+        for future in self.pending:
+            future.exception()
+        self.close()
+        if self.peaks:
+            print(f'Peak RSS per compressed image: max {max(self.peaks) / 2**20:.0f} MB, '
+                  f'mean {sum(self.peaks) / len(self.peaks) / 2**20:.0f} MB')
+        return self.errors
+
+    def close(self, cancel=False):
+        """Stop the pools and remove the intermediate files, cancel drops the work not started yet.
+
+        Must run however the pipeline ends, the work folder is usually in RAM."""
+        for pool in (self.convert_pool, self.upscale_pool, self.compress_pool, self.compress_procs):
+            pool.shutdown(cancel_futures=cancel)
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
 def main(args):
     if os.path.isdir(args.input_file):
         directory = args.input_file
+    else:
+        directory = os.path.dirname(args.input_file)
+    cache = OutputCache(os.path.join(directory, CACHE_NAME))
+
+    if os.path.isdir(args.input_file):
         extensions = ['.jpg', '.JPG', '.jpeg', '.JPEG']
+        # Our previous outputs are jpg files as well, they are not inputs
+        produced = cache.output_files()
         files = [os.path.join(directory, f) for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)) and any(f.endswith(ext) for ext in extensions)]
+        files = [f for f in files if f not in produced and not is_output(f)]
         print('Files to be processed : ' + str(files))
     else:
         files = [args.input_file]
 
-    for file in files:
-        png_file = convert_jpg_to_png(file)
-        if args.all:
-            for model in models:
-                upscaled_file = upscale(png_file, scale=args.scale,
-                                      model_name=model,
-                                    model_path=models[model])
-                compressed_file = compress(upscaled_file, args.output_file)
-        else:
-            upscaled_file = upscale(png_file, scale=args.scale,
-                                    model_name=args.model,
-                                   model_path=models[args.model])
-            compressed_file = compress(upscaled_file, args.output_file)
+    model_names = list(models) if args.all else [args.model]
+    memory_limit = args.memory_mb * 2**20 if args.memory_mb else None
+    pipeline = Pipeline(args.convert_jobs, args.upscale_jobs, args.compress_jobs,
+                        args.upscayl_bin, args.gpu_id, args.tmp_dir, args.keep_intermediates,
+                        memory_limit)
+    comparison = None
+    if args.all and args.output_file is None:
+        comparison = Comparison(model_names, args.scale, os.path.join(directory, COMPARISON_NAME))
+
+    def on_done(file, keys, model, stats):
+        cache.add(keys[model], stats['output'])
+        if comparison is not None:
+            comparison.add(file, model, stats)
+
+    try:
+        for file in files:
+            digest = cache.digest(file)
+            keys = {model: OutputCache.key(digest, model, models[model], args.scale) for model in model_names}
+            missing = [model for model in model_names if args.force or cache.lookup(keys[model]) is None]
+            if not missing:
+                print(f'Skipping {file}, already upscaled')
+                continue
+            on_finished = None
+            if comparison is not None:
+                on_finished = lambda file=file: comparison.finish(file)
+            pipeline.submit(file, missing, args.scale, args.output_file,
+                            lambda model, stats, file=file, keys=keys: on_done(file, keys, model, stats),
+                            on_finished, comparison is not None)
+        errors = pipeline.join()
+    finally:
+        # Already done by join() unless interrupted
+        pipeline.close(cancel=True)
+        cache.save()
+        if comparison is not None:
+            comparison.save()
+    if errors:
+        sys.exit(1)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='convert input to png, upscale it, compress it to jpg')
@@ -115,6 +576,24 @@ def parse_args():
                         help='Model to use for upscaling ' + str([model for model in models]))
     parser.add_argument('-a', '--all', action='store_true',
                         help='Perform upscalling with every model for comparison, this will take a while')
+    parser.add_argument('--convert-jobs', type=int, default=1,
+                        help='Number of files converted to png at the same time')
+    parser.add_argument('--upscale-jobs', type=int, default=1,
+                        help='Number of upscayl processes running at the same time')
+    parser.add_argument('--compress-jobs', type=int, default=1,
+                        help='Number of files compressed to jpg at the same time')
+    parser.add_argument('--upscayl-bin', default=__upscayl__,
+                        help='upscayl binary to use, default ' + __upscayl__)
+    parser.add_argument('-g', '--gpu-id', default=None,
+                        help='Device passed to upscayl, e.g. -1 for its CPU backend when supported')
+    parser.add_argument('-t', '--tmp-dir', default=None,
+                        help='Folder for the intermediate png files, default /dev/shm when available')
+    parser.add_argument('-k', '--keep-intermediates', action='store_true',
+                        help='Keep the intermediate png files next to the input')
+    parser.add_argument('--memory-mb', type=int, default=None,
+                        help='Estimated memory the upscayl processes and compressions running at the same time can use')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Upscale again even the files the cache shows as already done')
     parser.add_argument('-v', '--version', action='version', version=__name_version__)
     args = parser.parse_args()
 